@@ -5,7 +5,7 @@ import json
 from pathlib import Path
 import pprint
 import struct
-from typing import ClassVar, Dict, List, Tuple, Type
+from typing import ClassVar, Dict, List, Optional, Tuple, Type
 from ctypes import LittleEndianStructure, c_uint32, c_uint16
 
 
@@ -172,49 +172,86 @@ class BatHistoryIe(DbLibEntry):
 
 
 
-# align for sw1, not for sw2
-def parse_dblib(buf: bytes, align: bool) -> Tuple[List[Tuple[int, bytes]], bool]:
-    info = []
-
-    off = 0
-    while off < len(buf):
-        ie, length = struct.unpack_from(f"<HH", buf, off)
-        off += 4
+class DbLibDecoder:
+    """Parses a dblib dump fed in pieces, e.g. as it arrives in a debug dump
+
+    feed() returns the (ie, value) entries completed so far, cksum_valid is
+    set once the END entry has been seen.
+    """
+
+    # align for sw1, not for sw2
+    def __init__(self, align: bool):
+        self.align = align
+        self.buf = bytearray()
+        # offset of buf[0] in the dump, alignment is relative to its start
+        self.off = 0
+        self.sum = 0
+        self.cksum_valid: Optional[bool] = None
+
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+        info = []
+        if self.cksum_valid is not None:
+            return info
+        self.buf += data
+        buf = self.buf
+
+        pos = 0
+        while len(buf) - pos >= 4:
+            ie, length = struct.unpack_from(f"<HH", buf, pos)
+
+            if ie == 0xffff:
+                if len(buf) - pos < 8:
+                    break
+                # update count
+                info.append((ie, bytes(buf[pos + 2 : pos + 6])))
+                # checksum
+                cksum, = struct.unpack_from(f"<H", buf, pos + 6)
+                self.cksum_valid = (self.sum + sum(buf[:pos + 6])) % 0x10000 == cksum
+                pos += 8
+                break
+
+            end = pos + 4 + length
+            if self.align:
+                # align off
+                end = (self.off + end + 3) // 4 * 4 - self.off
+            if end > len(buf):
+                break
+            info.append((ie, bytes(buf[pos + 4 : pos + 4 + length])))
+            pos = end
+
+        self.sum += sum(buf[:pos])
+        self.off += pos
+        del buf[:pos]
+        return info
 
-        if ie == 0xffff:
-            off -= 2
-            # update count
-            info.append((ie, buf[off : off + 4]))
-            # checksum
-            cksum, = struct.unpack_from(f"<H", buf, off + 4)
-            cksum_valid = sum(buf[:off + 4]) % 0x10000 == cksum
-            return info, cksum_valid
 
-        info.append((ie, buf[off : off + length]))
-        off += length
-        if align:
-            # align off
-            off = (off + 3) // 4 * 4
-
-    # didn't find proper end!
-    return info, False
+# align for sw1, not for sw2
+def parse_dblib(buf: bytes, align: bool) -> Tuple[List[Tuple[int, bytes]], bool]:
+    decoder = DbLibDecoder(align)
+    info = decoder.feed(buf)
+    # didn't find proper end if still None
+    return info, bool(decoder.cksum_valid)
 
 
 def maybe_string_value(val: bytes) -> bool:
     return val != b'\x00' and all(map(lambda x: x >= 0x20 and x < 0x7f, val.removesuffix(b'\x00')))
 
 
-def decode(raw_ie: int, val: bytes):
+def describe(raw_ie: int, val: bytes) -> str:
     try:
         entry = DbLibEntry.parse(raw_ie, val)
         # print(json.dumps(entry))
         # pprint.pprint(entry)
-        print(entry.IE_VAL, entry)
+        return f'{entry.IE_VAL} {entry}'
     except KeyError:
         ie = IE(raw_ie)
-        print(ie, val.hex())
+        return f'{ie} {val.hex()}'
     except ValueError:
-        print(f'unknown 0x{raw_ie:x}: {val.hex()}')
+        return f'unknown 0x{raw_ie:x}: {val.hex()}'
+
+
+def decode(raw_ie: int, val: bytes):
+    print(describe(raw_ie, val))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Union
+
+from pydantic import BaseModel
+
+from dblib import DbLibDecoder, describe
+from fileutil import write_atomic
+from wlog import WlogDecoder
+from wpp import (
+    CmdDebugDump,
+    CmdDebugDumpAck,
+    CmdDebugSet,
+    DebugDumpAnchor,
+    DebugDumpMask,
+    DebugDumpTypeEnum,
+    DebugMask,
+    RawDataReadMode,
+    RawDataReadModeEnum,
+)
+from wpp_session import WppSession, bulk
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MASK = DebugMask.DBLIB_DUMP | DebugMask.WLOG
+
+# fed a dump's payloads as they arrive, returns the records they complete
+Decoder = Callable[[bytes], Iterable[str]]
+# a new Decoder for every dump
+DecoderFactory = Callable[[], Decoder]
+
+
+def type_name(ty: Union[DebugDumpTypeEnum, int]) -> str:
+    """Store name of a dump type, types this version does not know by number"""
+    return ty.name if isinstance(ty, DebugDumpTypeEnum) else str(ty)
+
+
+def dblib_decoder(align: bool) -> DecoderFactory:
+    """dblib IEs, align for ScanWatch, not for ScanWatch 2"""
+
+    def new() -> Decoder:
+        decoder = DbLibDecoder(align)
+        return lambda data: [describe(ie, val) for ie, val in decoder.feed(data)]
+
+    return new
+
+
+def wlog_decoder(table: Dict[int, str]) -> DecoderFactory:
+    """Log lines, table is from wlog.create_string_table()"""
+    return lambda: WlogDecoder(table).feed
+
+
+class DumpRecord(BaseModel):
+    """One dump appended to a store"""
+
+    offset: int
+    size: int
+    anchor: int
+    time: datetime
+
+
+class DumpStore(BaseModel):
+    # bytes of the store file accounted for by dumps
+    size: int = 0
+    last_sync: Optional[datetime] = None
+    dumps: List[DumpRecord] = []
+
+
+class DumpManifest(BaseModel):
+    """Sync state of one device's debug dumps, kept next to its stores"""
+
+    address: str
+    # by DebugDumpTypeEnum name
+    stores: Dict[str, DumpStore] = {}
+    last_sync: Optional[datetime] = None
+
+
+class _DumpWriter:
+    """Sink appending one dump to its store and feeding it to its decoder"""
+
+    def __init__(self, sync: "DebugDumpSync"):
+        self.sync = sync
+        self.type: Optional[Union[DebugDumpTypeEnum, int]] = None
+        self.name = ""
+        self.f: Optional[BinaryIO] = None
+        self.decoder: Optional[Decoder] = None
+        self.size = 0
+        # data that arrived before its dump was announced
+        self.orphaned = 0
+
+    def __call__(self, frame: CmdDebugDump):
+        if frame.type is not None and frame.type.type != DebugDumpTypeEnum.NONE:
+            self.type = frame.type.type
+            self.name = type_name(self.type)
+            self.f = open(self.sync.store_path(self.name), "ab")
+            factory = self.sync.decoders.get(self.type)
+            self.decoder = factory() if factory is not None else None
+
+        for array in bulk(frame):
+            data = array.getbuffer()
+            if not data:
+                continue
+            if self.f is None:
+                self.orphaned += len(data)
+                continue
+            self.f.write(data)
+            self.size += len(data)
+            if self.decoder is not None:
+                self._decode(data)
+
+    def check(self, rsp: CmdDebugDump):
+        """Raises IOError if frames of the dump were lost
+
+        Acknowledging it would lose the rest for good.
+        """
+        if self.orphaned:
+            raise IOError(f"{self.orphaned} bytes of dump data arrived unannounced")
+        if self.type is not None and self.size != rsp.type.size:
+            raise IOError(f"{self.name} dump is {self.size} bytes, {rsp.type.size} announced")
+
+    def _decode(self, data: memoryview):
+        try:
+            records = self.decoder(data)
+        except Exception:
+            # the raw dump is still saved
+            logger.exception("%s decoder failed at byte %d, not decoding the rest", self.name, self.size)
+            self.decoder = None
+            return
+        for record in records:
+            self.sync.on_record(self.name, record)
+
+    def close(self, discard: bool = False):
+        if self.f is None:
+            return
+        if discard:
+            # never recorded, the device sends it again
+            store = self.sync.manifest.stores.get(self.name)
+            self.f.truncate(store.size if store is not None else 0)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+class DebugDumpSync:
+    """Incremental debug dumps of one device, appended to a store per type
+
+    Everything lives in <root>/<address>/: a <TYPE>.bin store for each
+    DebugDumpTypeEnum and sync.json recording where each dump starts.  The
+    first sync asks for everything (WPP_RAW_DATA_READ_ALL and
+    DBLIB_FORCE_DUMP_ALL), later ones only for what the device has not sent
+    yet (WPP_RAW_DATA_READ_NOT_SENT).  Dumps are acknowledged with
+    CMD_DEBUG_DUMP_ACK once all of them are on disk.  If any dump arrives
+    short of the size the device announced the sync fails with IOError,
+    nothing is recorded or acknowledged and the device sends it all again.
+
+    Each dump is also fed to the decoder for its type as it streams in,
+    on_record is called with the type's name and every record decoded
+    (logged by default).
+    Types without a decoder, e.g. RAW, are only stored.
+    """
+
+    def __init__(
+        self,
+        root: os.PathLike,
+        address: str,
+        mask: DebugMask = DEFAULT_MASK,
+        decoders: Optional[Dict[DebugDumpTypeEnum, DecoderFactory]] = None,
+        on_record: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.dir = Path(root) / address.replace(":", "")
+        self.manifest_path = self.dir / "sync.json"
+        self.mask = mask
+        self.decoders = decoders or {}
+        self.on_record = on_record or (lambda name, record: logger.info("%s: %s", name, record))
+        self.manifest = self._load(address)
+
+    def _load(self, address: str) -> DumpManifest:
+        try:
+            manifest = DumpManifest.model_validate_json(self.manifest_path.read_text())
+        except FileNotFoundError:
+            return DumpManifest(address=address)
+
+        for name, store in manifest.stores.items():
+            path = self.store_path(name)
+            size = path.stat().st_size if path.exists() else 0
+            if size > store.size:
+                # appended but never checkpointed, the device sends it again
+                logger.warning("%s: dropping %d unrecorded bytes", path.name, size - store.size)
+                os.truncate(path, store.size)
+            elif size < store.size:
+                logger.warning("%s is shorter than recorded, starting over", path)
+                manifest.stores[name] = DumpStore()
+                path.unlink(missing_ok=True)
+        return manifest
+
+    def _save(self):
+        write_atomic(self.manifest_path, self.manifest.model_dump_json(indent=1))
+
+    def store_path(self, name: str) -> Path:
+        return self.dir / f"{name}.bin"
+
+    @property
+    def incremental(self) -> bool:
+        return self.manifest.last_sync is not None
+
+    async def run(self, session: WppSession, full: bool = False) -> Dict[str, int]:
+        """Appends every new dump to its store, returns the bytes added per type
+
+        full asks for everything again, as on the first sync.  The stores
+        and sync.json it would duplicate are kept as <name>.1, replacing
+        those of the full sync before.
+        """
+        full = full or not self.incremental
+        if full and self.manifest.stores:
+            self._rotate()
+        checkpoint = self.manifest.model_copy(deep=True)
+        with session.metrics.time("debug_dump_sync"):
+            try:
+                added = await self._run(session, full)
+            except BaseException:
+                self._restore(checkpoint)
+                raise
+            # saved before acknowledging and kept whatever happens next: if
+            # the ack is lost the dumps are sent again and stored twice,
+            # never acknowledged and not stored
+            await session.transact(CmdDebugDumpAck())
+            # back to the default
+            await session.transact(CmdDebugSet(mask=DebugDumpMask(mask=DebugMask.DBLIB_DUMP)))
+
+        for name, size in added.items():
+            logger.info("%s: %d new bytes", self.store_path(name).name, size)
+        return added
+
+    def _rotate(self):
+        for path in [self.store_path(name) for name in self.manifest.stores] + [self.manifest_path]:
+            if path.exists():
+                os.replace(path, path.with_name(path.name + ".1"))
+        # a first sync again if this one fails
+        self.manifest = DumpManifest(address=self.manifest.address)
+
+    def _restore(self, checkpoint: DumpManifest):
+        """Back to checkpoint, dropping everything appended since"""
+        for name in self.manifest.stores:
+            store = checkpoint.stores.get(name)
+            path = self.store_path(name)
+            if path.exists():
+                os.truncate(path, store.size if store is not None else 0)
+        self.manifest = checkpoint
+
+    async def _run(self, session: WppSession, full: bool) -> Dict[str, int]:
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if full:
+            mask = self.mask | DebugMask.DBLIB_FORCE_DUMP_ALL
+            mode = RawDataReadModeEnum.WPP_RAW_DATA_READ_ALL
+        else:
+            mask = self.mask
+            mode = RawDataReadModeEnum.WPP_RAW_DATA_READ_NOT_SENT
+
+        added: Dict[str, int] = {}
+        now = datetime.now(timezone.utc)
+        anchor: Optional[DebugDumpAnchor] = DebugDumpAnchor(value=0)
+        while anchor is not None:
+            await session.transact(CmdDebugSet(mask=DebugDumpMask(mask=mask)))
+            # frames queue up in the session while the previous one is
+            # written and decoded
+            writer = _DumpWriter(self)
+            try:
+                rsp: CmdDebugDump = await session.stream_into(
+                    CmdDebugDump(anchor=anchor, read_mode=RawDataReadMode(mode=mode)), writer
+                )
+                writer.check(rsp)
+            except BaseException:
+                writer.close(discard=True)
+                raise
+            writer.close()
+            if writer.size:
+                added[writer.name] = added.get(writer.name, 0) + writer.size
+                self._record(writer.name, writer.size, anchor.value, now)
+            anchor = rsp.anchor
+
+        self.manifest.last_sync = now
+        # one checkpoint for the whole sync
+        self._save()
+        return added
+
+    def _record(self, name: str, size: int, anchor: int, now: datetime):
+        store = self.manifest.stores.setdefault(name, DumpStore())
+        store.dumps.append(DumpRecord(offset=store.size, size=size, anchor=anchor, time=now))
+        store.size += size
+        store.last_sync = now
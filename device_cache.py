@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from bleak import BleakClient, BleakScanner
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+from bleak.exc import BleakError
+from pydantic import BaseModel
+
+from fileutil import write_atomic
+from fleet import DeviceModel, advertised_model
+from wpp import ProbeReply
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = Path("~/.cache/scanwatch/devices.json").expanduser()
+
+
+class CachedDevice(BaseModel):
+    address: str
+    model: str
+    service_uuid: str
+    last_seen: datetime
+    # from the last ProbeReply
+    name: Optional[str] = None
+    mac: Optional[str] = None
+    hard_version: Optional[int] = None
+    bl_version: Optional[int] = None
+    soft_version: Optional[int] = None
+
+
+class _CacheFile(BaseModel):
+    devices: Dict[str, CachedDevice] = {}
+
+
+class DeviceCache:
+    """Devices seen before, so a connection can be tried without scanning
+
+    Entries not seen for max_age are dropped when the cache is loaded.
+    """
+
+    def __init__(self, path: os.PathLike = DEFAULT_PATH, max_age: timedelta = timedelta(days=30)):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.devices: Dict[str, CachedDevice] = {}
+        self.load()
+
+    def load(self):
+        try:
+            self.devices = _CacheFile.model_validate_json(self.path.read_text()).devices
+        except FileNotFoundError:
+            self.devices = {}
+        except ValueError:
+            logger.warning("ignoring unreadable device cache %s", self.path)
+            self.devices = {}
+
+        cutoff = datetime.now(timezone.utc) - self.max_age
+        self.devices = {addr: dev for addr, dev in self.devices.items() if dev.last_seen >= cutoff}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.path, _CacheFile(devices=self.devices).model_dump_json(indent=1))
+
+    def seen(self, address: str, model: DeviceModel):
+        dev = self.devices.get(address)
+        now = datetime.now(timezone.utc)
+        if dev is None or dev.service_uuid != model.service_uuid:
+            self.devices[address] = CachedDevice(address=address, model=model.name, service_uuid=model.service_uuid, last_seen=now)
+        else:
+            dev.model = model.name
+            dev.last_seen = now
+        self.save()
+
+    def probed(self, address: str, reply: Optional[ProbeReply]):
+        dev = self.devices.get(address)
+        if dev is None or reply is None:
+            return
+        dev.name = reply.name
+        dev.mac = reply.mac
+        dev.hard_version = reply.hard_version
+        dev.bl_version = reply.bl_version
+        dev.soft_version = reply.soft_version
+        self.save()
+
+    def forget(self, address: str):
+        if self.devices.pop(address, None) is not None:
+            self.save()
+
+    def candidates(self, models: Iterable[DeviceModel]) -> List[Tuple[CachedDevice, DeviceModel]]:
+        """Cached devices of one of models, most recently seen first"""
+        by_uuid = {model.service_uuid: model for model in models}
+        found = [(dev, by_uuid[dev.service_uuid]) for dev in self.devices.values() if dev.service_uuid in by_uuid]
+        return sorted(found, key=lambda x: x[0].last_seen, reverse=True)
+
+    async def _scan(self, models: Iterable[DeviceModel], timeout: float) -> Tuple[BLEDevice, DeviceModel]:
+        found: Dict[str, DeviceModel] = {}
+
+        def match(device: BLEDevice, adv: AdvertisementData):
+            model = advertised_model(adv, models)
+            if model is None:
+                return False
+            found[device.address] = model
+            return True
+
+        device = await BleakScanner.find_device_by_filter(match, timeout=timeout)
+        if device is None:
+            raise BleakError("no matching device found")
+        return device, found[device.address]
+
+    @contextlib.asynccontextmanager
+    async def connect(
+        self,
+        models: Iterable[DeviceModel],
+        disconnected_callback: Optional[Callable[[BleakClient], None]] = None,
+        direct_timeout: float = 10.0,
+        scan_timeout: float = 30.0,
+    ) -> AsyncIterator[Tuple[BleakClient, DeviceModel]]:
+        """Connects to a device of one of models, trying cached addresses before scanning"""
+        models = list(models)
+        client = None
+        for dev, model in self.candidates(models):
+            attempt = BleakClient(
+                dev.address,
+                disconnected_callback=disconnected_callback,
+                services=(model.service_uuid,),
+                timeout=direct_timeout,
+            )
+            try:
+                await attempt.connect()
+            except (BleakError, asyncio.TimeoutError, OSError) as e:
+                logger.info("cached %s %s not reachable: %s", dev.model, dev.address, e)
+                continue
+            client = attempt
+            break
+
+        if client is None:
+            device, model = await self._scan(models, scan_timeout)
+            client = BleakClient(device, disconnected_callback=disconnected_callback, services=(model.service_uuid,))
+            await client.connect()
+
+        self.seen(client.address, model)
+        try:
+            yield client, model
+        finally:
+            await client.disconnect()
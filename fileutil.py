@@ -0,0 +1,16 @@
+"""File helpers shared by the manifest, cache and metrics writers"""
+
+import os
+from pathlib import Path
+
+
+def write_atomic(path: os.PathLike, text: str):
+    """Writes text to path through a temporary file renamed into place
+
+    Readers, and a run interrupted halfway, see the old file or the new one,
+    never part of either.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
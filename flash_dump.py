@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Literal, Optional, Tuple
+
+from pydantic import BaseModel
+
+from fileutil import write_atomic
+from wpp import CmdSpiFlash, SpiFlashCmd, WppCmd, WppErrorEnum
+from wpp_session import WppErrorResponse, WppSession, bulk
+
+
+logger = logging.getLogger(__name__)
+
+
+class FlashRange(BaseModel):
+    addr: int
+    len: int
+    status: Literal["pending", "done"] = "pending"
+    crc: Optional[int] = None
+
+
+class FlashManifest(BaseModel):
+    """Checkpoint of a flash dump, kept next to the output file"""
+
+    addr: int
+    len: int
+    ranges: List[FlashRange]
+
+
+class FlashProgress(BaseModel):
+    done: int
+    total: int
+    # bytes/s over this run
+    rate: float
+    # seconds
+    eta: float
+
+    def __str__(self) -> str:
+        return f"{self.done:#x}/{self.total:#x} ({100 * self.done / self.total:.1f}%) {self.rate / 1024:.1f} KiB/s eta {self.eta:.0f}s"
+
+
+# bytes of flash per SpiFlashChunk
+_CHUNK = 16
+
+
+class _RangeWriter:
+    """Sink writing the chunks of one request at its offset in the output file"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.left = 0
+        self.crc = 0
+
+    def start(self, offset: int, length: int):
+        self.f.seek(offset)
+        # the device sends whole chunks, only the last may run past the request
+        self.left = length
+
+    def __call__(self, frame: WppCmd):
+        for array in bulk(frame):
+            data = array.getbuffer()
+            if not data:
+                continue
+            if self.left <= 0 or len(data) - self.left >= _CHUNK:
+                # e.g. the rest of another read, the range stays pending
+                raise IOError(f"{len(data)} bytes arrived with {self.left} left to read")
+            data = data[: self.left]
+            self.f.write(data)
+            self.crc = zlib.crc32(data, self.crc)
+            self.left -= len(data)
+
+
+class _SizeStats:
+    def __init__(self):
+        self.n = 0
+        # EWMA of bytes/s and seconds per request
+        self.rate = 0.0
+        self.latency = 0.0
+
+    def add(self, rate: float, latency: float, alpha: float):
+        if self.n == 0:
+            self.rate, self.latency = rate, latency
+        else:
+            self.rate += alpha * (rate - self.rate)
+            self.latency += alpha * (latency - self.latency)
+        self.n += 1
+
+
+class ReadPlanner:
+    """Picks CmdSpiFlash request lengths by measuring what the link achieves
+
+    Request sizes are powers of two between min_size and max_size.  The
+    planner hill climbs: the current size and its two neighbours are measured
+    samples times, then it moves to whichever is fastest.  Every reprobe
+    requests a neighbour is measured again, so it follows the link as it
+    changes.  ARG_INVAL caps the size below the one rejected, DEVBUSY steps
+    down one size and waits before retrying.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 0x100,
+        max_size: int = 0x10000,
+        start: int = 0x2000,
+        samples: int = 3,
+        reprobe: int = 32,
+        alpha: float = 0.25,
+    ):
+        self.sizes: List[int] = []
+        size = min_size
+        while size <= max_size:
+            self.sizes.append(size)
+            size *= 2
+        self.stats = [_SizeStats() for _ in self.sizes]
+        # sizes at or above this index were refused by the device
+        self.cap = len(self.sizes)
+        self.current = min(range(self.cap), key=lambda i: abs(self.sizes[i] - start))
+        self.samples = samples
+        self.reprobe = reprobe
+        self.alpha = alpha
+        self.requests = 0
+        self.busy_delay = 0.0
+
+    def _neighbours(self) -> List[int]:
+        return [i for i in (self.current - 1, self.current, self.current + 1) if 0 <= i < self.cap]
+
+    def next_size(self) -> int:
+        self.requests += 1
+        for i in (self.current, self.current + 1, self.current - 1):
+            if 0 <= i < self.cap and self.stats[i].n < self.samples:
+                return self.sizes[i]
+
+        if self.requests % self.reprobe == 0:
+            # alternate between probing up and down
+            up = (self.requests // self.reprobe) % 2 == 0
+            i = self.current + (1 if up else -1)
+            if 0 <= i < self.cap:
+                return self.sizes[i]
+
+        self.current = max(self._neighbours(), key=lambda i: self.stats[i].rate)
+        return self.sizes[self.current]
+
+    def record(self, size: int, seconds: float):
+        """Time from sending a request of size to its Null"""
+        self.busy_delay = 0.0
+        if size in self.sizes:
+            self.stats[self.sizes.index(size)].add(size / seconds, seconds, self.alpha)
+
+    async def failed(self, size: int, err: WppErrorEnum) -> bool:
+        """Adjusts to a CMD_ERROR for a request of size, False if not worth retrying"""
+        i = self.sizes.index(size) if size in self.sizes else self.current
+        if err == WppErrorEnum.ARG_INVAL:
+            if i == 0:
+                return False
+            logger.info("request size %#x refused, capping at %#x", size, self.sizes[i - 1])
+            self.cap = min(self.cap, i)
+            self.current = min(self.current, self.cap - 1)
+            return True
+
+        if err == WppErrorEnum.DEVBUSY:
+            self.current = max(0, min(self.current, i) - 1)
+            self.busy_delay = min(max(2 * self.busy_delay, 0.1), 5.0)
+            logger.info("device busy, waiting %.1fs and dropping to %#x", self.busy_delay, self.sizes[self.current])
+            await asyncio.sleep(self.busy_delay)
+            return True
+
+        return False
+
+    def curve(self) -> List[Tuple[int, float, float, int]]:
+        """(size, bytes/s, seconds per request, samples) for every size measured"""
+        return [(size, s.rate, s.latency, s.n) for size, s in zip(self.sizes, self.stats) if s.n]
+
+    def report(self) -> str:
+        lines = ["    size      KiB/s   ms/req      n"]
+        for size, rate, latency, n in self.curve():
+            mark = " <" if size == self.sizes[self.current] else ""
+            lines.append(f"{size:#8x} {rate / 1024:10.1f} {latency * 1000:8.1f} {n:6d}{mark}")
+        return "\n".join(lines)
+
+
+class FlashDump:
+    """Resumable dump of a flash region into a file
+
+    The region is checkpointed in step sized ranges.  After every completed
+    range the manifest at <path>.json is rewritten, so calling run() again,
+    e.g. with a new session after the link dropped, only reads what is still
+    missing.  Each range is read in one request, or in requests sized by
+    planner if one is given.
+    """
+
+    def __init__(
+        self,
+        path: os.PathLike,
+        addr: int,
+        length: int,
+        step: int = 0x10000,
+        progress: Optional[Callable[[FlashProgress], None]] = None,
+        planner: Optional[ReadPlanner] = None,
+    ):
+        self.path = Path(path)
+        self.planner = planner
+        self.manifest_path = self.path.with_name(self.path.name + ".json")
+        self.progress = progress or (lambda p: logger.info("%s: %s", self.path.name, p))
+        self.manifest = self._load(addr, length, step)
+
+    def _load(self, addr: int, length: int, step: int) -> FlashManifest:
+        if self.manifest_path.exists() and self.path.exists():
+            manifest = FlashManifest.model_validate_json(self.manifest_path.read_text())
+            if manifest.addr == addr and manifest.len == length:
+                self._verify(manifest)
+                return manifest
+            logger.warning("%s is for a different region, starting over", self.manifest_path)
+
+        ranges = [
+            FlashRange(addr=start, len=min(step, addr + length - start))
+            for start in range(addr, addr + length, step)
+        ]
+        return FlashManifest(addr=addr, len=length, ranges=ranges)
+
+    def _verify(self, manifest: FlashManifest):
+        # whatever is on disk must still match what was checkpointed
+        with open(self.path, "rb") as f:
+            for r in manifest.ranges:
+                if r.status != "done":
+                    continue
+                f.seek(r.addr - manifest.addr)
+                if zlib.crc32(f.read(r.len)) != r.crc:
+                    logger.warning("%s: range %#x +%#x fails CRC, reading again", self.path.name, r.addr, r.len)
+                    r.status = "pending"
+                    r.crc = None
+
+    def _save(self):
+        write_atomic(self.manifest_path, self.manifest.model_dump_json(indent=1))
+
+    @property
+    def done(self) -> bool:
+        return all(r.status == "done" for r in self.manifest.ranges)
+
+    def remaining(self) -> int:
+        return sum(r.len for r in self.manifest.ranges if r.status != "done")
+
+    async def run(self, session: WppSession):
+        """Reads every pending range, raises if the session fails midway"""
+        with session.metrics.time("flash_dump"):
+            await self._run(session)
+
+    async def _run(self, session: WppSession):
+        total = self.manifest.len
+        start = time.monotonic()
+        read = 0
+
+        self.path.touch()
+        self._save()
+
+        with open(self.path, "r+b") as f:
+            f.truncate(total)
+            for r in self.manifest.ranges:
+                if r.status == "done":
+                    continue
+
+                crc = await self._read_range(session, f, r)
+
+                # data first, then the checkpoint that claims it
+                f.flush()
+                os.fsync(f.fileno())
+                r.status = "done"
+                r.crc = crc
+                self._save()
+
+                read += r.len
+                rate = read / (time.monotonic() - start)
+                self.progress(FlashProgress(done=total - self.remaining(), total=total, rate=rate, eta=self.remaining() / rate))
+
+        if self.planner is not None:
+            logger.info("%s: request size vs. rate\n%s", self.path.name, self.planner.report())
+
+    async def _read_range(self, session: WppSession, f: BinaryIO, r: FlashRange) -> int:
+        """Reads r into f, returns its CRC"""
+        writer = _RangeWriter(f)
+        addr = r.addr
+        end = r.addr + r.len
+        while addr < end:
+            size = end - addr
+            if self.planner is not None:
+                size = min(self.planner.next_size(), size)
+
+            writer.start(addr - self.manifest.addr, size)
+            sent = time.monotonic()
+            try:
+                await session.stream_into(CmdSpiFlash(cmd=SpiFlashCmd(addr=addr, len=size)), writer)
+            except WppErrorResponse as e:
+                if self.planner is None or not await self.planner.failed(size, e.error.err):
+                    raise
+                # the CRC covers the whole range, start it over
+                addr = r.addr
+                writer.crc = 0
+                continue
+
+            if writer.left:
+                raise IOError(f"read of {addr:#x} +{size:#x} came back {writer.left} bytes short")
+            if self.planner is not None:
+                self.planner.record(size, time.monotonic() - sent)
+            addr += size
+
+        return writer.crc
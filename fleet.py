@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import sys
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from bleak import BleakClient, BleakScanner
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+
+from wpp import CmdBatteryPercent, CmdBatteryStatus, CmdDisconnect
+from transport import BleakTransport
+from wpp_session import WppSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceModel(NamedTuple):
+    name: str
+    service_uuid: str
+    tx_rx_uuid: str
+
+
+MODELS = (
+    DeviceModel("ScanWatch", "00000020-5749-5448-005d-000000000000", "00000023-5749-5448-005d-000000000000"),
+    DeviceModel("ScanWatch 2", "00000020-5749-5448-005e-000000000000", "00000023-5749-5448-005e-000000000000"),
+    DeviceModel("Body+", "00000020-5749-5448-0005-000000000000", "00000024-5749-5448-0005-000000000000"),
+)
+
+
+def advertised_model(adv: AdvertisementData, models: Iterable[DeviceModel]) -> Optional[DeviceModel]:
+    """The one of models whose service adv advertises, if any"""
+    uuids = {uuid.lower() for uuid in adv.service_uuids}
+    for model in models:
+        if model.service_uuid.lower() in uuids:
+            return model
+    return None
+
+
+class FleetDevice:
+    """A device found by the scan, with the jobs still to run on it"""
+
+    def __init__(self, device: BLEDevice, model: DeviceModel):
+        self.device = device
+        self.model = model
+        self.jobs: asyncio.Queue["Job"] = asyncio.Queue()
+        # (job name, return value or the exception it raised)
+        self.results: List[Tuple[str, Any]] = []
+
+    @property
+    def address(self) -> str:
+        return self.device.address
+
+    def __repr__(self) -> str:
+        return f"{self.model.name} {self.address}"
+
+
+# run with a probed session, e.g. a FlashDump or a battery read
+Job = Callable[[WppSession, FleetDevice], Awaitable[Any]]
+
+
+class Fleet:
+    """Syncs every known Withings device in range
+
+    One scan finds all devices advertising a service of models, then up to
+    concurrency of them are connected at once.  Each device runs the jobs
+    added for every device followed by the ones added for its address, each
+    job gets the same probed session.
+
+    kl_secrets maps a BLE address to the KL secret of that device, devices
+    without one are skipped.  With negotiate_mtu, the WPP MTU is agreed on
+    after the probe, firmware without CMD_MTU_EXCH keeps the transport's.
+    """
+
+    def __init__(
+        self,
+        kl_secrets: Mapping[str, str],
+        models: Tuple[DeviceModel, ...] = MODELS,
+        concurrency: int = 3,
+        scan_time: float = 10.0,
+        negotiate_mtu: bool = False,
+    ):
+        self.kl_secrets = {addr.upper(): secret for addr, secret in kl_secrets.items()}
+        self.models = models
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.scan_time = scan_time
+        self.negotiate_mtu = negotiate_mtu
+        self.common_jobs: List[Job] = []
+        self.device_jobs: Dict[str, List[Job]] = {}
+        self.devices: Dict[str, FleetDevice] = {}
+
+    def add_job(self, job: Job, address: Optional[str] = None):
+        """Adds job for the device at address, or for all devices"""
+        if address is None:
+            self.common_jobs.append(job)
+        else:
+            self.device_jobs.setdefault(address.upper(), []).append(job)
+
+    async def scan(self) -> List[FleetDevice]:
+        def detected(device: BLEDevice, adv: AdvertisementData):
+            if device.address.upper() in self.devices:
+                return
+            model = advertised_model(adv, self.models)
+            if model is not None:
+                logger.info("found %s %s", model.name, device.address)
+                self.devices[device.address.upper()] = FleetDevice(device, model)
+
+        async with BleakScanner(detection_callback=detected):
+            await asyncio.sleep(self.scan_time)
+
+        return list(self.devices.values())
+
+    async def sync(self, dev: FleetDevice):
+        """Connects to dev and runs its queued jobs"""
+        secret = self.kl_secrets.get(dev.address.upper())
+        if secret is None:
+            logger.warning("%r: no KL secret, skipping", dev)
+            return
+
+        transport: Optional[BleakTransport] = None
+
+        def disconnected(_: BleakClient):
+            if transport is not None:
+                transport.lost(ConnectionError(f"{dev!r} disconnected"))
+
+        async with self.concurrency:
+            async with BleakClient(dev.device, disconnected_callback=disconnected, services=(dev.model.service_uuid,)) as client:
+                char = client.services.get_service(dev.model.service_uuid).get_characteristic(dev.model.tx_rx_uuid)
+                transport = BleakTransport(client, char)
+                async with WppSession(transport) as session:
+                    await session.probe(secret)
+                    if self.negotiate_mtu:
+                        await session.negotiate_mtu()
+
+                    while not dev.jobs.empty():
+                        job = dev.jobs.get_nowait()
+                        name = getattr(job, "__name__", repr(job))
+                        try:
+                            dev.results.append((name, await job(session, dev)))
+                        except ConnectionError:
+                            raise
+                        except Exception as e:
+                            logger.exception("%r: job %s failed", dev, name)
+                            dev.results.append((name, e))
+
+                    await session.transact(CmdDisconnect())
+
+    async def run(self) -> Dict[str, FleetDevice]:
+        """Scans, then syncs every device found; jobs left queued failed to run"""
+        for dev in await self.scan():
+            for job in self.common_jobs + self.device_jobs.get(dev.address.upper(), []):
+                dev.jobs.put_nowait(job)
+
+        async def guarded(dev: FleetDevice):
+            try:
+                await self.sync(dev)
+            except Exception:
+                logger.exception("%r: sync failed", dev)
+
+        await asyncio.gather(*(guarded(dev) for dev in self.devices.values()))
+        return self.devices
+
+
+async def battery(session: WppSession, dev: FleetDevice):
+    status, pct = await session.transact_many([CmdBatteryStatus(), CmdBatteryPercent()])
+    return status.status, pct.voltage
+
+
+if __name__ == "__main__":
+    # fleet.py ADDRESS=KL_SECRET ...
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    fleet = Fleet(dict(arg.split("=", 1) for arg in sys.argv[1:]))
+    fleet.add_job(battery)
+    for dev in asyncio.run(fleet.run()).values():
+        print(dev, dev.results)
@@ -4,9 +4,8 @@ from datetime import datetime
 from enum import Enum
 import hashlib
 import random
-import secrets
-import sys
 import asyncio
+from pathlib import Path
 from pydantic import BaseModel
 import logging
 import fw_parser
@@ -16,41 +15,33 @@ from bleak import BleakClient
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
-)
 
 import asyncio
-import sys
-from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Annotated
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Annotated
 
-from bleak import BleakClient, BleakScanner
+from bleak import BleakClient
 from bleak.backends.characteristic import BleakGATTCharacteristic
-from bleak.backends.device import BLEDevice
-from bleak.backends.scanner import AdvertisementData
 
 from wpp import (
-    CmdBatteryPercent,
+    BatteryStatus,
     CmdBatteryStatus,
-    CmdDebugDump,
-    CmdDebugDumpAck,
-    CmdDebugSet,
     CmdDisconnect,
-    CmdError,
-    CmdProbe,
-    CmdProbeChallenge,
-    CmdSpiFlash,
     CmdSwimStatus,
     CmdTrackerUserGet,
-    DebugDumpAnchor,
-    DebugDumpMask,
+    DebugDumpTypeEnum,
     DebugMask,
-    ProbeChallenge,
-    SpiFlashCmd,
     SwimStatus,
-    WppCmd,
+    Type,
 )
+from debug_dump import DebugDumpSync, dblib_decoder, wlog_decoder
+from device_cache import DeviceCache
+from fleet import MODELS, DeviceModel
+from flash_dump import FlashDump, ReadPlanner
+from transport import BleakTransport
+from wlog import create_string_table
+from wpp_capture import CaptureTransport, CaptureWriter
+from wpp_session import WppSession
+from wpp_trace import PROFILES, FrameTrace, configure
 
 
 
@@ -69,22 +60,31 @@ WATCH_TX_RX_UUID = "00000023-5749-5448-005e-000000000000"
 # WATCH_SERVICE_UUID = "00000020-5749-5448-0005-000000000000"
 # WATCH_TX_RX_UUID = "00000024-5749-5448-0005-000000000000"
 
+# set to a file name to record the raw session, replay it with wpp_capture.py
+CAPTURE_PATH = None
+# set to a file name prefix to write session metrics as .json and .prom
+METRICS_PATH = None
+# "debug" logs every frame in full, "trace" one line per frame, see wpp_trace.py
+LOG_PROFILE = "production"
+# agree on a larger WPP MTU with CMD_MTU_EXCH, not known to work on every firmware
+NEGOTIATE_MTU = False
+# debug dumps are appended to one store per device and type in here
+DUMP_DIR = "debug_dumps"
+# ask for everything again instead of only what the watch has not sent yet, the
+# stores so far are kept as <type>.bin.1
+FULL_DUMP = False
+# dblib entries are 4 byte aligned on the ScanWatch, not on the ScanWatch 2
+DBLIB_ALIGN = True
+# set to the firmware's string table (see wlog.py) to print wlog lines as the dump arrives
+WLOG_STRINGS = None
 
-async def watch_service():
-    def match_watch_uuid(device: BLEDevice, adv: AdvertisementData):
-        # TODO: also check MAC for Withings?
-        if WATCH_SERVICE_UUID.lower() in adv.service_uuids:
-            return True
-
-        return False
-
-    device: Optional[BLEDevice] = await BleakScanner.find_device_by_filter(
-        match_watch_uuid, timeout=30
-    )
 
-    if device is None:
-        print("no matching device found, you may need to edit WATCH_SERVICE_UUID")
-        sys.exit(1)
+async def watch_service():
+    # the device seen last is connected to directly, scanning only if that fails
+    cache = DeviceCache()
+    models = tuple(model for model in MODELS if model.service_uuid == WATCH_SERVICE_UUID.lower())
+    if not models:
+        models = (DeviceModel("configured device", WATCH_SERVICE_UUID, WATCH_TX_RX_UUID),)
 
     def handle_disconnect(client: BleakClient):
         print("Device was disconnected, goodbye.")
@@ -94,7 +94,8 @@ async def watch_service():
 
         # client.unpair()
 
-    async with BleakClient(device, disconnected_callback=handle_disconnect, services=(WATCH_SERVICE_UUID,)) as client:
+    # TODO: also check MAC for Withings?
+    async with cache.connect(models, disconnected_callback=handle_disconnect) as (client, _):
         print(f"Connected to {client.address}")
 
         # enumerate for debug
@@ -141,37 +142,11 @@ async def watch_service():
 
         print(f"service: {service} char: {tx_rx_char}")
 
-        rxq: asyncio.Queue[WppCmd] = asyncio.Queue()
-        rx_buf = bytearray()
-
-        async def do_read(_: BleakGATTCharacteristic, data: bytearray):
-            nonlocal rx_buf
-
-            rx_buf.extend(data)
-
-            try:
-                cmd_id, l, slave_req = WppCmd.decode_header(rx_buf)
-                if len(rx_buf) < l:
-                    return
-
-                if slave_req:
-                    print(f"###### RX {l:3d} bytes: ignoring SLAVE_REQ | {cmd_id}: {rx_buf[:l].hex()}")
-                    rx_buf = rx_buf[l:]
-                    return
-
-                cmd = WppCmd.deserialize(bytes(rx_buf[:l]))
-                print(f"###### RX {l:3d} bytes: {repr(cmd)}")
-                rx_buf = rx_buf[l:]
-            except:
-                logger.exception(
-                    "failed to unpack %d bytes: %s", len(rx_buf), rx_buf.hex()
-                )
-                await client.disconnect()
-                return
-
-            await rxq.put(cmd)
-
-        await client.start_notify(tx_rx_char, do_read)
+        transport = BleakTransport(client, tx_rx_char)
+        if CAPTURE_PATH is not None:
+            transport = CaptureTransport(transport, CaptureWriter(CAPTURE_PATH))
+        session = WppSession(transport, trace=FrameTrace(hex_every=PROFILES[LOG_PROFILE].hex_every))
+        await session.start()
 
         # cmds are always:
         # 01
@@ -181,59 +156,20 @@ async def watch_service():
         #
         # some commands have Null arguments (0100_0000)
 
-        async def transact(cmd: WppCmd) -> WppCmd:
-            data = cmd.serialize()
-            print(f"###### TX {len(data):3d} bytes: {repr(cmd)}")
-            await client.write_gatt_char(tx_rx_char, data, response=True)
-            rsp = await rxq.get()
-            if isinstance(rsp, CmdError):
-                raise Exception(rsp)
-
-            return rsp
-
-        async def transact_until_null(cmd: WppCmd) -> WppCmd:
-            rsp = await transact(cmd)
-            if isinstance(rsp, CmdError):
-                raise Exception(rsp)
-
-            while rsp.null is None:
-                rsp.merge_from(await rxq.get())
-
-            return rsp
-
-        # --send--> 0101 ~ CMD_PROBE
-        rsp = await transact(CmdProbe())
-
-        # <--read-- 0128 ~ CMD_PROBE_CHALLENGE
-        # <--read--  + 0122 ~ ProbeChallenge(mac = 00:24:e4:xx:xx:xx, challenge = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx ) # completely random
-        if isinstance(rsp, CmdProbeChallenge):
-            # --send--> 0128 ~ CMD_PROBE_CHALLENGE
-            # --send-->  + 0123 ~ ProbeChallengeResponse(           answer = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
-            # --send-->  + 0122 ~ ProbeChallenge(mac = 00:24:e4:xx:xx:xx, challenge = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
-            challenge = ProbeChallenge(
-                mac=rsp.challenge.mac,
-                challenge=secrets.token_bytes(16),
-            )
-            rsp = await transact(
-                CmdProbeChallenge(
-                    response=rsp.challenge.make_response(KL_SECRET),
-                    challenge=challenge,
-                )
-            )
-
-            # <--read-- 0101 ~ CMD_PROBE
-            # <--read--  + 0123 ~ ProbeChallengeResponse(           answer = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
-            # <--read--  + 0101 ~ ProbeReply(vid = 0, pid = 0, name = ScanWatch, mac = 00:24:e4:xx:xx:xx, secret = xxxxxxxxxxxxxxxx, hardVersion = 16777215, mfgId = 001F0080, blVersion = 6, softVersion = 2741, rescueVersion = 16777215)
-            # <--read--  + 012C ~ FactoryState(value = 0)
-            assert isinstance(rsp, CmdProbe)
-            assert rsp.response == challenge.make_response(KL_SECRET)
+        # CMD_PROBE, answering CMD_PROBE_CHALLENGE if the device sends one
+        rsp = await session.probe(KL_SECRET)
+        cache.probed(client.address, rsp.reply)
 
         print("CONNECTED!")
 
-        rsp = await transact(CmdTrackerUserGet())
+        # larger writes once the device agrees
+        if NEGOTIATE_MTU:
+            await session.negotiate_mtu()
+
+        rsp = await session.transact(CmdTrackerUserGet())
 
         # turn on swim tracking (not persistent?)
-        # await transact(CmdSwimStatus(status=SwimStatus(enabled=True)))
+        # await session.transact(CmdSwimStatus(status=SwimStatus(enabled=True)))
 
         # enable this block to dump flash
         if False:
@@ -248,57 +184,51 @@ async def watch_service():
                 # ("fw_1", 0x11f000, 995528),
             )
 
+            # request sizes are tuned over the whole session
+            planner = ReadPlanner()
             for name, addr, length in REGIONS:
                 print(f'dumping {name} @ {addr:x} +{length:x}')
-                rsp = await transact_until_null(CmdSpiFlash(cmd=SpiFlashCmd(addr=addr, len=length)))
-
-                with open(f'flash_{name}_{addr:x}_{length:x}.bin', 'wb') as f:
-                    for c in rsp.chunks:
-                        f.write(c.data)
+                # checkpointed next to the .bin, rerun after a link drop to resume
+                await FlashDump(f'flash_{name}_{addr:x}_{length:x}.bin', addr, length, planner=planner).run(session)
 
-        # enable this block to log battery every 30 seconds forever (not very useful)
+        # enable this block to log battery changes forever, polling if the watch is quiet for 30 seconds
         if False:
             with open('bat_log.csv', 'w') as f:
                 f.write('time, percent, state, mv\n')
-                while True:
-                    status = await transact(CmdBatteryStatus())
-                    pct = await transact(CmdBatteryPercent())
-                    f.write(f'{datetime.now().isoformat()}, {status.status.percent}, {status.status.state}, {pct.voltage.mv}\n')
+
+                def log_battery(status: BatteryStatus):
+                    f.write(f'{datetime.now().isoformat()}, {status.percent}, {status.state}, {status.mv}\n')
                     f.flush()
-                    await asyncio.sleep(30)
 
-        # enable this block to perform a debug dump with the requested mask
+                async def poll_battery() -> BatteryStatus:
+                    return (await session.transact(CmdBatteryStatus())).status
+
+                await session.on(Type.TYPE_BATTERY_STATUS, log_battery, poll=poll_battery, deadline=30)
+
+        # enable this block to sync debug dumps with the requested mask
         if True:
-            # TODO: debug dump
-            # Procedure:
-            # CMD_DEBUG_DUMP anchor = 0
-            anchor = DebugDumpAnchor(value=0)
-
-            while anchor is not None:
-                # CMD_DEBUG_SET mask = 1
-                rsp = await transact(CmdDebugSet(mask=DebugDumpMask(mask=DebugMask.DBLIB_DUMP | DebugMask.DBLIB_FORCE_DUMP_ALL | DebugMask.WLOG)))
-                # read sequence:
-                #   CMD_DEBUG_DUMP DebugDumpType
-                #   CMD_DEBUG_DUMP DebugDumpData x 3
-                #   CMD_DEBUG_DUMP DebugDumpAnchor + Null
-                rsp: CmdDebugDump = await transact_until_null(CmdDebugDump(anchor=anchor))
-
-                if rsp.type is not None:
-                    with open(f'debug_dump_{rsp.type.type.name}_{rsp.type.size}.bin', 'wb') as f:
-                        for d in rsp.data:
-                            f.write(d.buf)
-
-                # repeat until we no longer have an anchor
-                anchor = rsp.anchor
-
-            rsp = await transact(CmdDebugDumpAck())
-
-            # reset the mask to the default
-            rsp = await transact(CmdDebugSet(mask=DebugDumpMask(mask=DebugMask.DBLIB_DUMP)))
-
-        rsp = await transact(CmdDisconnect())
+            # appended to DUMP_DIR/<address>/<type>.bin, only new data after the first sync
+            # decoded while the dump is still streaming in
+            decoders = {DebugDumpTypeEnum.DBLIB: dblib_decoder(DBLIB_ALIGN)}
+            if WLOG_STRINGS is not None:
+                decoders[DebugDumpTypeEnum.WLOG] = wlog_decoder(create_string_table(Path(WLOG_STRINGS)))
+            sync = DebugDumpSync(
+                DUMP_DIR,
+                client.address,
+                mask=DebugMask.DBLIB_DUMP | DebugMask.WLOG,
+                decoders=decoders,
+                on_record=lambda name, record: print(f'{name}: {record}'),
+            )
+            added = await sync.run(session, full=FULL_DUMP)
+            print(f'debug dump: {added or "nothing new"}')
+
+        rsp = await session.transact(CmdDisconnect())
         assert isinstance(rsp, CmdDisconnect)
 
+        if METRICS_PATH is not None:
+            session.metrics.write_json(f"{METRICS_PATH}.json")
+            session.metrics.write_prometheus(f"{METRICS_PATH}.prom", device=client.address)
+
         # await asyncio.sleep(1)
 
         await client.disconnect()
@@ -306,7 +236,8 @@ async def watch_service():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(watch_service(), debug=True)
+        profile = configure(LOG_PROFILE)
+        asyncio.run(watch_service(), debug=profile.asyncio_debug)
     except asyncio.CancelledError:
         # task is cancelled on disconnect, so we ignore this error
         pass
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import pty
+import termios
+import tty
+from typing import Callable, Optional, Tuple
+
+from bleak import BleakClient
+from bleak.backends.characteristic import BleakGATTCharacteristic
+
+
+class Transport:
+    """Moves raw bytes between a WppSession and a device
+
+    Received data is handed to on_receive in whatever fragments the link
+    delivers it, the framer reassembles frames.  on_disconnect is called once
+    when the link goes away, with the reason if there is one.
+    """
+
+    # ATT_MTU every BLE link supports, less the 3 byte ATT header
+    MIN_MTU = 20
+
+    def __init__(self):
+        self.on_receive: Callable[[bytes], None] = lambda data: None
+        self.on_disconnect: Callable[[Optional[BaseException]], None] = lambda exc: None
+
+    @property
+    def mtu(self) -> int:
+        """Largest single write the link allows"""
+        return self.MIN_MTU
+
+    @property
+    def connected(self) -> bool:
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def send(self, data: bytes, response: bool = True):
+        """Writes one fragment, response asks the link to acknowledge it if it can"""
+        raise NotImplementedError
+
+    def lost(self, exc: Optional[BaseException] = None):
+        """Reports the link going away, e.g. from bleak's disconnected_callback"""
+        self.on_disconnect(exc)
+
+
+class BleakTransport(Transport):
+    """Notifications and writes on a device's TX/RX characteristic"""
+
+    def __init__(self, client: BleakClient, char: BleakGATTCharacteristic):
+        super().__init__()
+        self.client = client
+        self.char = char
+
+    @property
+    def mtu(self) -> int:
+        try:
+            return max(self.MIN_MTU, self.client.mtu_size - 3)
+        except Exception:
+            return self.MIN_MTU
+
+    @property
+    def connected(self) -> bool:
+        return self.client.is_connected
+
+    async def start(self):
+        await self.client.start_notify(self.char, lambda _, data: self.on_receive(data))
+
+    async def stop(self):
+        if self.client.is_connected:
+            await self.client.stop_notify(self.char)
+
+    async def send(self, data: bytes, response: bool = True):
+        await self.client.write_gatt_char(self.char, data, response=response)
+
+
+class LoopbackTransport(Transport):
+    """One end of an in-process link, see pair()
+
+    Writes are delivered to the other end from the event loop, like a
+    notification would be, never from inside send().
+    """
+
+    def __init__(self, mtu: int = 244):
+        super().__init__()
+        self._mtu = mtu
+        self.peer: Optional["LoopbackTransport"] = None
+        self.closed = False
+
+    @classmethod
+    def pair(cls, mtu: int = 244) -> Tuple["LoopbackTransport", "LoopbackTransport"]:
+        a, b = cls(mtu), cls(mtu)
+        a.peer, b.peer = b, a
+        return a, b
+
+    @property
+    def mtu(self) -> int:
+        return self._mtu
+
+    @property
+    def connected(self) -> bool:
+        return not self.closed
+
+    async def stop(self):
+        self.close()
+
+    def close(self):
+        """Disconnects both ends"""
+        for end in (self, self.peer):
+            if not end.closed:
+                end.closed = True
+                end.lost()
+
+    async def send(self, data: bytes, response: bool = True):
+        if self.closed:
+            raise ConnectionError("loopback closed")
+        if len(data) > self._mtu:
+            raise ValueError(f"{len(data)} byte write over the {self._mtu} byte MTU")
+        asyncio.get_running_loop().call_soon(self.peer._deliver, bytes(data))
+        if response:
+            # an acknowledged write waits for the far end to have seen it
+            await asyncio.sleep(0)
+
+    def _deliver(self, data: bytes):
+        if not self.closed:
+            self.on_receive(data)
+
+
+class FdTransport(Transport):
+    """Byte stream on a file descriptor, e.g. a serial port or a pty
+
+    There is no write size limit on a stream, mtu only bounds how much is
+    written at once.
+    """
+
+    def __init__(self, fd: int, mtu: int = 4096):
+        super().__init__()
+        self.fd = fd
+        self._mtu = mtu
+        self.closed = False
+        os.set_blocking(fd, False)
+
+    @classmethod
+    def open_serial(cls, path: str, baud: Optional[int] = None) -> "FdTransport":
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(fd)
+        if baud is not None:
+            attrs = termios.tcgetattr(fd)
+            attrs[4] = attrs[5] = getattr(termios, f"B{baud}")
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        return cls(fd)
+
+    @classmethod
+    def pty_pair(cls) -> Tuple["FdTransport", "FdTransport"]:
+        """Both ends of a raw pty, the second may also be opened by name from os.ttyname()"""
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        return cls(master), cls(slave)
+
+    @property
+    def mtu(self) -> int:
+        return self._mtu
+
+    @property
+    def connected(self) -> bool:
+        return not self.closed
+
+    async def start(self):
+        asyncio.get_running_loop().add_reader(self.fd, self._readable)
+
+    async def stop(self):
+        self.close()
+
+    def close(self, exc: Optional[BaseException] = None):
+        if self.closed:
+            return
+        self.closed = True
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+        self.lost(exc)
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # EIO once the other end of a pty is closed
+            self.close(e)
+            return
+        if not data:
+            self.close()
+            return
+        self.on_receive(data)
+
+    async def send(self, data: bytes, response: bool = True):
+        view = memoryview(data)
+        while view:
+            if self.closed:
+                raise ConnectionError("stream closed")
+            try:
+                view = view[os.write(self.fd, view) :]
+            except BlockingIOError:
+                pass
+            if view:
+                await self._writable()
+
+    async def _writable(self):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_writer(self.fd, ready.set_result, None)
+        try:
+            await ready
+        finally:
+            loop.remove_writer(self.fd)
@@ -88,33 +88,54 @@ def args_tuple(fmt: str, buf: bytes) -> Tuple:
 
 
 
+class WlogDecoder:
+    """Formats wlog records fed in pieces, e.g. as they arrive in a debug dump"""
+
+    def __init__(self, table: Dict[int, str]):
+        self.table = table
+        self.buf = bytearray()
+
+    def feed(self, data: bytes) -> List[str]:
+        lines = []
+        self.buf += data
+        buf = self.buf
+
+        off = 0
+        while len(buf) - off >= 11:
+            # 1b zero?
+            # 1b arglen:
+            # 1b loglevel
+            # 4b timestamp
+            # 4b format string
+            # args...
+            _sbz, arglen, level, ts, fmtcrc = struct.unpack_from(f"<BBBII", buf, off)
+            assert _sbz == 0
+            if len(buf) - off < 11 + arglen:
+                break
+            off += 11
+            argbuf = bytes(buf[off:off + arglen])
+            off += arglen
+
+            ts = datetime.fromtimestamp(ts)
+
+            fmt = "!!! UNKNOWN STR !!!"
+
+            try:
+                fmt = self.table[fmtcrc].strip()
+                args = args_tuple(fmt, argbuf)
+                msg = fmt % args
+
+                lines.append(f'{ts.isoformat()} {LOGLEVEL_NAME[level]:5s}  {msg}')
+            except Exception as e:
+                lines.append(f'!!! ERROR {e}: {argbuf.hex()} {fmt}')
+
+        del buf[:off]
+        return lines
+
+
 def print_wlog(buf: bytes, table: Dict[int, str]):
-    off = 0
-    while off < len(buf):
-        # 1b zero?
-        # 1b arglen:
-        # 1b loglevel
-        # 4b timestamp
-        # 4b format string
-        # args...
-        _sbz, arglen, level, ts, fmtcrc = struct.unpack_from(f"<BBBII", buf, off)
-        assert _sbz == 0
-        off += 11
-
-        ts = datetime.fromtimestamp(ts)
-
-        fmt = "!!! UNKNOWN STR !!!"
-
-        try:
-            fmt = table[fmtcrc].strip()
-            args = args_tuple(fmt, buf[off:off + arglen])
-            msg = fmt % args
-
-            print(f'{ts.isoformat()} {LOGLEVEL_NAME[level]:5s}  {msg}')
-        except Exception as e:
-            print(f'!!! ERROR {e}: {buf[off:off + arglen].hex()} {fmt}')
-
-        off += arglen
+    for line in WlogDecoder(table).feed(buf):
+        print(line)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
-from datetime import date, datetime
+from array import array
+from datetime import date, datetime, timezone
 from enum import Enum, IntEnum, IntFlag, unique
+import functools
 import hashlib
 import struct
 import typing
 from typing import (
     Annotated,
+    Callable,
     ClassVar,
     Dict,
     List,
@@ -18,8 +21,8 @@ from typing import (
 from inspect import get_annotations
 
 from annotated_types import Len, Interval
-from pydantic import BaseModel, Strict
-from pydantic_extra_types.mac_address import MacAddress
+from pydantic import AfterValidator, BaseModel, Field, Strict, ValidationError, WrapValidator
+from pydantic_core import core_schema
 
 
 @unique
@@ -745,7 +748,17 @@ class Type(Enum):
 ################# TYPES #################
 
 
-# MacAddress = Annotated[str, Len(17, 17)]
+def _mac_address(val: str) -> str:
+    # normalised like pydantic_extra_types' MacAddress, which is slow to import
+    digits = val.translate(_MAC_SEPARATORS)
+    if len(digits) != 12 or not all(c in "0123456789abcdefABCDEF" for c in digits):
+        raise ValueError(f"invalid MAC address {val!r}")
+    return ":".join(digits[i : i + 2] for i in range(0, 12, 2)).lower()
+
+
+_MAC_SEPARATORS = str.maketrans("", "", ":-.")
+
+MacAddress = Annotated[str, AfterValidator(_mac_address)]
 RandomChallenge = Annotated[bytes, Len(16, 16), Strict()]
 SHA1Hash = Annotated[bytes, Len(20, 20), Strict()]
 UINT8 = Annotated[int, Interval(ge=0, le=0xFF)]
@@ -753,12 +766,20 @@ UINT16 = Annotated[int, Interval(ge=0, le=0xFFFF)]
 UINT32 = Annotated[int, Interval(ge=0, le=0xFFFFFFFF)]
 BOOL = Annotated[int, Interval(ge=0, le=1)]
 
+# anything deserialize() can walk without copying
+Buffer = Union[bytes, bytearray, memoryview]
+
 
 class WppType(BaseModel, ABC):
     TYPE_MAP: ClassVar[Dict[Type, typing.Type["WppType"]]] = {}
+    # same as TYPE_MAP keyed by the raw type ID, which is what the wire has
+    TYPE_ID_MAP: ClassVar[Dict[int, typing.Type["WppType"]]] = {}
 
     def __init_subclass__(cls, **kwargs):
-        WppType.TYPE_MAP[cls.ID()] = cls
+        # RawTlv has a per instance ID() and is never looked up
+        if isinstance(cls.__dict__.get("ID"), staticmethod):
+            WppType.TYPE_MAP[cls.ID()] = cls
+            WppType.TYPE_ID_MAP[cls.ID().value] = cls
         return super().__init_subclass__(**kwargs)
 
     @staticmethod
@@ -774,66 +795,295 @@ class WppType(BaseModel, ABC):
 
         raise RuntimeError(f'size unknown for {ty}')
 
+    @classmethod
+    def _codec(cls) -> "_TypeCodec":
+        # compiled on first use so importing doesn't pay for every type
+        codec = _TYPE_CODECS.get(cls)
+        if codec is None:
+            codec = _TYPE_CODECS[cls] = _TypeCodec(cls)
+        return codec
+
     def serialize(self) -> bytes:
-        data = b""
-        for name, ty in get_annotations(self.__class__).items():
-            val = getattr(self, name)
-            if val is None:
-                continue
-            if isinstance(val, bytes):
-                assert len(val) < 256
-                data += struct.pack(f">{len(val) + 1}p", val)
-            elif isinstance(val, int):
-                # we *must* have metadata for the size
-                size, signed = WppType._size_from_metadata(ty)
-                data += val.to_bytes(size, "big", signed=signed)
-            elif isinstance(val, str):
-                val = val.encode()
-                assert len(val) < 256
-                data += struct.pack(f">{len(val) + 1}p", val)
-            else:
-                # hope it has one of these!
-                data += val.serialize()
+        out = bytearray()
+        self.serialize_into(out)
+        return bytes(out)
 
-        return struct.pack(f">HH", self.ID().value, len(data)) + data
+    def serialize_into(self, out: bytearray):
+        # reserve the header, the length is patched in once the value is written
+        start = len(out)
+        out += b"\0\0\0\0"
+        self._codec().encode(self, out)
+        _TLV_HEADER.pack_into(out, start, self.ID().value, len(out) - start - 4)
 
     @classmethod
-    def deserialize(cls, ty: Type, data: bytes) -> "WppType":
-        subcls = cls.TYPE_MAP[ty]
-        kwargs = {}
+    def deserialize(cls, ty: Union[Type, int], data: Buffer, trusted: bool = False) -> "WppType":
+        typeid = ty.value if isinstance(ty, Type) else ty
+        subcls = cls.TYPE_ID_MAP.get(typeid)
+        if subcls is None:
+            return RawTlv(type=typeid, data=bytes(data))
+        return subcls._decode(data, trusted)
 
-        # serially pull data in order
-        # validation will be from pydantic
-        for name, ty in get_annotations(subcls).items():
-            size = None
-            real_type = ty
+    @classmethod
+    def _decode(cls, data: Buffer, trusted: bool = False) -> "WppType":
+        codec = cls._codec()
+        kwargs = codec.decode(data)
+        if trusted and codec.trusted:
+            # the codec already fixed the width and signedness of every field
+            return codec.construct(kwargs)
+        return cls(**kwargs)
+
+
+_TYPE_CODECS: Dict[typing.Type[WppType], "_TypeCodec"] = {}
+
+_TLV_HEADER = struct.Struct(">HH")
+
+_object_new = object.__new__
+_object_setattr = object.__setattr__
+
+
+class _Constructor:
+    """Builds a model from already decoded values without validating them
+
+    This is what BaseModel.model_construct() does, minus the per call field
+    introspection which makes it slower than validation itself.
+    """
+
+    def __init__(self, cls: typing.Type[BaseModel]):
+        self.cls = cls
+        # (name, has_default, default, default_factory) in declaration order,
+        # which is the order pydantic keeps them in __dict__
+        self.fields_defaults = tuple(
+            (name, not field.is_required(), field.default, field.default_factory)
+            for name, field in cls.model_fields.items()
+        )
+        self.reorder = any(has_default for _, has_default, _, _ in self.fields_defaults)
+        self.private = {
+            name: attr.get_default() for name, attr in cls.__private_attributes__.items()
+        }
+
+    def construct(self, kwargs: Dict[str, typing.Any]) -> BaseModel:
+        fields_set = set(kwargs)
+        if self.reorder:
+            values = {}
+            for name, has_default, default, factory in self.fields_defaults:
+                if name in fields_set:
+                    values[name] = kwargs[name]
+                elif factory is not None:
+                    values[name] = factory()
+                elif has_default:
+                    values[name] = default
+            kwargs = values
+
+        obj = _object_new(self.cls)
+        _object_setattr(obj, "__dict__", kwargs)
+        _object_setattr(obj, "__pydantic_fields_set__", fields_set)
+        _object_setattr(obj, "__pydantic_extra__", None)
+        _object_setattr(obj, "__pydantic_private__", dict(self.private) if self.private else None)
+        return obj
+
+
+_INT_FORMATS = {
+    (1, False): "B",
+    (1, True): "b",
+    (2, False): "H",
+    (2, True): "h",
+    (4, False): "I",
+    (4, True): "i",
+    (8, False): "Q",
+    (8, True): "q",
+}
+
+
+def _timestamp(val: datetime) -> int:
+    # naive datetimes are UTC, as produced by utcfromtimestamp()
+    if val.tzinfo is None:
+        val = val.replace(tzinfo=timezone.utc)
+    return int(val.timestamp())
+
+
+def _enum_decoder(enum: typing.Type[Enum]) -> Callable[[int], typing.Any]:
+    # values newer firmware added are kept as plain ints instead of failing
+    # the whole frame
+    def decode(val: int) -> typing.Any:
+        try:
+            return enum(val)
+        except ValueError:
+            return val
+
+    return decode
+
+
+def _keep_unknown(val: typing.Any, handler: Callable[[typing.Any], typing.Any]) -> typing.Any:
+    # the validating counterpart of _enum_decoder, for Annotated enum fields
+    try:
+        return handler(val)
+    except ValidationError:
+        if type(val) is int:
+            return val
+        raise
+
+
+# an enum field that also takes values this version does not know
+UnknownInt = WrapValidator(_keep_unknown)
+
+
+class _StructStep:
+    """A run of consecutive fixed width fields packed with a single Struct"""
+
+    def __init__(self, fields: List[Tuple[str, str, Optional[Callable], Optional[Callable]]]):
+        self.struct = struct.Struct(">" + "".join(fmt for _, fmt, _, _ in fields))
+        self.names = tuple(name for name, _, _, _ in fields)
+        self.decoders = tuple(dec for _, _, dec, _ in fields)
+        self.encoders = tuple(enc for _, _, _, enc in fields)
+        # plain ints can go straight from unpack_from() into the kwargs
+        self.simple = not any(self.decoders) and not any(
+            name.startswith("_") for name in self.names
+        )
+
+    def decode(self, data: Buffer, off: int, kwargs: Dict[str, typing.Any]) -> int:
+        vals = self.struct.unpack_from(data, off)
+        if self.simple:
+            kwargs.update(zip(self.names, vals))
+        else:
+            for name, dec, val in zip(self.names, self.decoders, vals):
+                if name.startswith("_"):
+                    continue
+                kwargs[name] = val if dec is None else dec(val)
+        return off + self.struct.size
+
+    def encode(self, obj: "WppType", out: bytearray):
+        vals = []
+        for name, enc in zip(self.names, self.encoders):
+            val = getattr(obj, name)
+            vals.append(val if enc is None else enc(val))
+        out += self.struct.pack(*vals)
+
+
+class _IntStep:
+    """An integer with a width struct has no format for"""
+
+    def __init__(self, name: str, size: int, signed: bool):
+        self.name = name
+        self.size = size
+        self.signed = signed
+
+    def decode(self, data: Buffer, off: int, kwargs: Dict[str, typing.Any]) -> int:
+        end = off + self.size
+        if not self.name.startswith("_"):
+            kwargs[self.name] = int.from_bytes(data[off:end], "big", signed=self.signed)
+        return end
+
+    def encode(self, obj: "WppType", out: bytearray):
+        out += getattr(obj, self.name).to_bytes(self.size, "big", signed=self.signed)
+
+
+class _PascalStep:
+    """A length prefixed bytes or str field"""
+
+    def __init__(self, name: str, text: bool):
+        self.name = name
+        self.text = text
+
+    def decode(self, data: Buffer, off: int, kwargs: Dict[str, typing.Any]) -> int:
+        end = off + 1 + data[off]
+        # only now copy out of the (possibly shared) receive buffer
+        val = data[off + 1 : end]
+        kwargs[self.name] = str(val, "utf-8") if self.text else bytes(val)
+        return end
+
+    def encode(self, obj: "WppType", out: bytearray):
+        val = getattr(obj, self.name)
+        if val is None:
+            return
+        if self.text:
+            val = val.encode()
+        assert len(val) < 256
+        out.append(len(val))
+        out += val
+
+
+class _NestedStep:
+    """A WppType embedded in another, carried as its own TLV"""
+
+    def __init__(self, name: str, ty: typing.Type["WppType"]):
+        self.name = name
+        self.ty = ty
+
+    def decode(self, data: Buffer, off: int, kwargs: Dict[str, typing.Any]) -> int:
+        typeid, typelen = struct.unpack_from(">HH", data, off)
+        end = off + 4 + typelen
+        kwargs[self.name] = WppType.deserialize(typeid, data[off + 4 : end])
+        return end
+
+    def encode(self, obj: "WppType", out: bytearray):
+        val = getattr(obj, self.name)
+        if val is not None:
+            val.serialize_into(out)
+
+
+class _TypeCodec(_Constructor):
+    """Field plan for a WppType subclass, built once from its annotations"""
+
+    def __init__(self, cls: typing.Type[WppType]):
+        super().__init__(cls)
+        self.steps: List[Union[_StructStep, _IntStep, _PascalStep, _NestedStep]] = []
+        # whether decoded kwargs can skip pydantic, which is not the case
+        # for fields pydantic would normalise (e.g. MacAddress)
+        self.trusted = True
+        run: List[Tuple[str, str, Optional[Callable], Optional[Callable]]] = []
+
+        def flush():
+            if run:
+                self.steps.append(_StructStep(run.copy()))
+                run.clear()
+
+        for name, ty in get_annotations(cls).items():
             if get_origin(ty) is Annotated:
                 real_type = get_args(ty)[0]
             else:
                 real_type = ty
 
             if issubclass(real_type, bytes):
-                size = data[0] + 1
-                kwargs[name] = data[1:size]
+                flush()
+                self.steps.append(_PascalStep(name, text=False))
             elif issubclass(real_type, int):
                 # we *must* have metadata for the size
                 size, signed = WppType._size_from_metadata(ty)
-                kwargs[name] = int.from_bytes(data[:size], "big", signed=signed)
-            elif issubclass(real_type, (int, date, datetime)):
-                size = 4
-                kwargs[name] = datetime.utcfromtimestamp(
-                    int.from_bytes(data[:size], "big")
-                )
+                fmt = _INT_FORMATS.get((size, signed))
+                dec = _enum_decoder(real_type) if issubclass(real_type, Enum) else None
+                if fmt is None:
+                    flush()
+                    self.steps.append(_IntStep(name, size, signed))
+                    self.trusted &= dec is None
+                else:
+                    run.append((name, fmt, dec, None))
+            elif issubclass(real_type, (date, datetime)):
+                run.append((name, "I", datetime.utcfromtimestamp, _timestamp))
             elif issubclass(real_type, str):
-                size = data[0] + 1
-                kwargs[name] = data[1:size].decode()
+                flush()
+                self.steps.append(_PascalStep(name, text=True))
+                self.trusted &= real_type is str and not any(
+                    isinstance(info, AfterValidator) for info in getattr(ty, "__metadata__", ())
+                )
             else:
                 # hope it has one of these!
-                size = real_type.deserialize(data)
+                flush()
+                self.steps.append(_NestedStep(name, real_type))
+                self.trusted = False
 
-            data = data[size:]
+        flush()
 
-        return subcls(**kwargs)
+    def decode(self, data: Buffer) -> Dict[str, typing.Any]:
+        # validation will be from pydantic
+        kwargs: Dict[str, typing.Any] = {}
+        off = 0
+        for step in self.steps:
+            off = step.decode(data, off, kwargs)
+        return kwargs
+
+    def encode(self, obj: WppType, out: bytearray):
+        for step in self.steps:
+            step.encode(obj, out)
 
 
 class ProbeChallengeResponse(WppType):
@@ -974,7 +1224,7 @@ class DebugDumpTypeEnum(IntEnum):
 
 
 class DebugDumpType(WppType):
-    type: Annotated[DebugDumpTypeEnum, Interval(ge=0, le=0xFFFFFFFF)]
+    type: Annotated[DebugDumpTypeEnum, UnknownInt, Interval(ge=0, le=0xFFFFFFFF)]
     size: UINT32
 
     @staticmethod
@@ -991,7 +1241,7 @@ class RawDataReadModeEnum(IntEnum):
 
 
 class RawDataReadMode(WppType):
-    mode: Annotated[RawDataReadModeEnum, Interval(ge=0, le=0xFFFFFFFF)]
+    mode: Annotated[RawDataReadModeEnum, UnknownInt, Interval(ge=0, le=0xFFFFFFFF)]
 
     @staticmethod
     def ID() -> Type:
@@ -1063,6 +1313,31 @@ class Gpio(WppType):
         return Type.TYPE_GPIO
 
 
+# MTU layout is a guess, a single big endian length
+class MtuWpp(WppType):
+    mtu: UINT16
+
+    @staticmethod
+    def ID() -> Type:
+        return Type.TYPE_MTU_WPP
+
+
+class MtuAttBle(WppType):
+    mtu: UINT16
+
+    @staticmethod
+    def ID() -> Type:
+        return Type.TYPE_MTU_ATT_BLE
+
+
+class MtuTls(WppType):
+    mtu: UINT16
+
+    @staticmethod
+    def ID() -> Type:
+        return Type.TYPE_MTU_TLS
+
+
 @unique
 class WppErrorEnum(IntEnum):
     ARG_NOT_SET = -9
@@ -1079,21 +1354,167 @@ class WppErrorEnum(IntEnum):
 class WppError(WppType):
     # cmd: Annotated[Cmd, Interval(ge=0, le=0xffff)]
     cmd: UINT16
-    err: Annotated[WppErrorEnum, Interval(ge=-0x80000000, le=0x7FFFFFFF)]
+    err: Annotated[WppErrorEnum, UnknownInt, Interval(ge=-0x80000000, le=0x7FFFFFFF)]
 
     @staticmethod
     def ID() -> Type:
         return Type.TYPE_CMDERROR
 
 
+class RawTlv(WppType):
+    """A TLV with no WppType here (or not expected in its command), kept undecoded"""
+
+    type: UINT16
+    data: Annotated[bytes, Strict()]
+
+    def ID(self) -> Union[Type, int]:
+        try:
+            return Type(self.type)
+        except ValueError:
+            return self.type
+
+    def serialize_into(self, out: bytearray):
+        out += _TLV_HEADER.pack(self.type, len(self.data))
+        out += self.data
+
+
+T = typing.TypeVar("T", bound=WppType)
+
+
+class TlvArray(typing.Generic[T]):
+    """Repeated TLVs of a WppType holding a single bytes field
+
+    The payloads are appended into one growable buffer with an offsets array
+    instead of keeping an object per TLV, so multi-megabyte flash or debug
+    dumps end up as a single contiguous buffer.  Iterating still yields the
+    WppType instances, built on demand.
+    """
+
+    def __init__(self, ty: typing.Type[T], items: typing.Iterable[T] = ()):
+        steps = ty._codec().steps
+        if len(steps) != 1 or not isinstance(steps[0], _PascalStep) or steps[0].text:
+            raise TypeError(f"{ty.__name__} is not a single bytes field")
+        self.ty = ty
+        self.field = steps[0].name
+        self.buf = bytearray()
+        self.offsets = array("I", (0,))
+        self.extend(items)
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: typing.Any, handler) -> core_schema.CoreSchema:
+        ty = get_args(source)[0]
+
+        def validate(val):
+            if isinstance(val, TlvArray) and val.ty is ty:
+                return val
+            return TlvArray(ty, val)
+
+        return core_schema.no_info_plain_validator_function(
+            validate, serialization=core_schema.plain_serializer_function_ser_schema(list)
+        )
+
+    def append(self, item: T):
+        self.append_payload(getattr(item, self.field))
+
+    def append_payload(self, payload: Buffer):
+        self.buf += payload
+        self.offsets.append(len(self.buf))
+
+    def append_tlv(self, value: Buffer):
+        # value of the TLV as sent on the wire, the bytes field is length prefixed
+        if not value:
+            # not even the length, take it as empty rather than fail the frame
+            self.append_payload(b"")
+            return
+        self.append_payload(value[1 : 1 + value[0]])
+
+    def extend(self, items: typing.Iterable[T]):
+        if isinstance(items, TlvArray):
+            base = len(self.buf)
+            self.buf += items.buf
+            self.offsets.extend(base + off for off in items.offsets[1:])
+            return
+
+        for item in items:
+            self.append(item)
+
+    def clear(self):
+        self.buf = bytearray()
+        self.offsets = array("I", (0,))
+
+    def payload(self, i: int) -> bytes:
+        return bytes(self.buf[self.offsets[i] : self.offsets[i + 1]])
+
+    def getbuffer(self) -> memoryview:
+        # like BytesIO.getbuffer(), appending fails while the view is held
+        return memoryview(self.buf)
+
+    def numpy(self):
+        import numpy as np
+
+        arr = np.frombuffer(self.buf, dtype=np.uint8)
+        sizes = set(np.diff(self.offsets))
+        if len(sizes) == 1:
+            # fixed size items (e.g. SpiFlashChunk) come back one per row
+            return arr.reshape(len(self), sizes.pop())
+        return arr
+
+    def serialize(self) -> bytes:
+        out = bytearray()
+        self.serialize_into(out)
+        return bytes(out)
+
+    def serialize_into(self, out: bytearray):
+        typeid = self.ty.ID().value
+        header = struct.Struct(">HHB")
+        view = memoryview(self.buf)
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            out += header.pack(typeid, end - start + 1, end - start)
+            out += view[start:end]
+        view.release()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> T:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.ty._codec().construct({self.field: self.payload(i)})
+
+    def __iter__(self) -> typing.Iterator[T]:
+        construct = self.ty._codec().construct
+        for start, end in zip(self.offsets, self.offsets[1:]):
+            yield construct({self.field: bytes(self.buf[start:end])})
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, TlvArray):
+            return self.ty is other.ty and self.offsets == other.offsets and self.buf == other.buf
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"TlvArray({self.ty.__name__}, {len(self)} items, {len(self.buf)} bytes)"
+
+
 ################# COMMANDS #################
 
 
 class WppCmd(BaseModel, ABC):
     CMD_MAP: ClassVar[Dict[Cmd, typing.Type["WppCmd"]]] = {}
+    # same as CMD_MAP keyed by the raw command ID, which is what the wire has
+    CMD_ID_MAP: ClassVar[Dict[int, typing.Type["WppCmd"]]] = {}
+
+    # TLVs the command doesn't declare, passed through as is
+    unknown: List[RawTlv] = Field(default_factory=list, repr=False)
 
     def __init_subclass__(cls, **kwargs):
-        WppCmd.CMD_MAP[cls.ID()] = cls
+        # RawCmd has a per instance ID() and is never looked up
+        if isinstance(cls.__dict__.get("ID"), staticmethod):
+            WppCmd.CMD_MAP[cls.ID()] = cls
+            WppCmd.CMD_ID_MAP[cls.ID().value] = cls
         return super().__init_subclass__(**kwargs)
 
     @staticmethod
@@ -1101,75 +1522,125 @@ class WppCmd(BaseModel, ABC):
     def ID() -> Cmd:
         raise NotImplementedError()
 
+    @classmethod
+    def _codec(cls) -> "_CmdCodec":
+        codec = _CMD_CODECS.get(cls)
+        if codec is None:
+            codec = _CMD_CODECS[cls] = _CmdCodec(cls)
+        return codec
+
     def serialize(self) -> bytes:
-        data = b""
-        for name, ty in get_annotations(self.__class__).items():
+        codec = self._codec()
+        # commands built without arguments always serialize the same, e.g.
+        # CmdProbe() or CmdBatteryStatus() sent by pollers
+        empty = not self.model_fields_set and not codec.list_factories and not self.unknown
+        if empty and codec.empty_frame is not None:
+            return codec.empty_frame
+
+        # reserve the header, the length is patched in once the TLVs are written
+        out = bytearray(5)
+        for name, is_list in codec.fields:
             val = getattr(self, name)
             if val is None:
                 continue
-            if isinstance(val, list):
+            if is_list:
+                if isinstance(val, TlvArray):
+                    val.serialize_into(out)
+                    continue
                 for item in val:
-                    data += item.serialize()
+                    item.serialize_into(out)
                 continue
 
-            data += val.serialize()
+            val.serialize_into(out)
+
+        for tlv in self.unknown:
+            tlv.serialize_into(out)
 
-        return struct.pack(f">BHH", 1, self.ID().value, len(data)) + data
+        cmd = self.ID()
+        _CMD_HEADER.pack_into(out, 0, 1, cmd.value if isinstance(cmd, Cmd) else cmd, len(out) - 5)
+        data = bytes(out)
+        if empty:
+            codec.empty_frame = data
+        return data
 
     @staticmethod
-    def decode_header(data: bytes) -> Tuple[Cmd, int, bool]:
+    def _decode_header(data: Buffer) -> Tuple[int, int, bool]:
         flag, cmd, l = struct.unpack_from(f">BHH", data)
         assert flag == 1
         slave_req = bool(cmd & Cmd.CMD_CHANNEL_SLAVE_REQUEST.value)
         cmd = cmd & ~Cmd.CMD_CHANNEL_SLAVE_REQUEST.value
-        return Cmd(cmd), l + 5, slave_req
+        return cmd, l + 5, slave_req
+
+    @staticmethod
+    def decode_header(data: Buffer) -> Tuple[Union[Cmd, int], int, bool]:
+        # IDs missing from Cmd are returned as plain ints
+        cmd, l, slave_req = WppCmd._decode_header(data)
+        try:
+            return Cmd(cmd), l, slave_req
+        except ValueError:
+            return cmd, l, slave_req
 
     @classmethod
-    def deserialize(cls, data: bytes) -> "WppCmd":
-        cmd, l, slave_req = WppCmd.decode_header(data)
+    def deserialize(
+        cls, data: Buffer, trusted: bool = False, types: Optional[typing.AbstractSet[int]] = None
+    ) -> "WppCmd":
+        # trusted skips pydantic validation for data which came off the wire,
+        # commands built by hand for sending are always validated
+        # types (raw type IDs) restricts which TLVs are decoded at all
+        cmd, l, slave_req = WppCmd._decode_header(data)
         assert l == len(data)
-        data = data[5:]
-        subcls = cls.CMD_MAP[cmd]
-        kwargs = {}
-
-        # build a reverse type ID -> name map
-        TYPE_MAP = {}
-        for name, ty in get_annotations(subcls).items():
-            origin = get_origin(ty)
-            if origin is Union or origin is list:
-                ty = get_args(ty)[0]
-                if origin is list:
-                    kwargs[name] = list()
-            TYPE_MAP[ty.ID()] = name
-
-        # find each type, deserialize it, and stick it into kwargs
-        while data:
-            typeid, typelen = struct.unpack_from(f">HH", data)
-            typeid = Type(typeid)
-            val = WppType.deserialize(typeid, data[4 : 4 + typelen])
-            name = TYPE_MAP[typeid]
-            existing = kwargs.get(name)
-            if existing is not None:
-                if isinstance(existing, list):
-                    existing.append(val)
-                else:
-                    raise AttributeError(
-                        f"{name} is not a list but value already assigned to {existing}"
-                    )
+        subcls = cls.CMD_ID_MAP.get(cmd)
+        if subcls is None:
+            subcls = RawCmd
+        codec = subcls._codec()
+        kwargs = codec.new_lists()
+        if subcls is RawCmd:
+            kwargs["cmd"] = cmd
+        unknown = []
+
+        # walk the TLVs by offset, slicing the view never copies
+        view = memoryview(data)
+        off = 5
+        while off < l:
+            typeid, typelen = struct.unpack_from(f">HH", view, off)
+            off += 4
+            value = view[off : off + typelen]
+            off += typelen
+            if types is not None and typeid not in types:
+                continue
+            entry = codec.type_map.get(typeid)
+            if entry is None:
+                unknown.append(RawTlv(type=typeid, data=bytes(value)))
+                continue
+            name, is_list, bulk, ty = entry
+            if bulk:
+                kwargs[name].append_tlv(value)
+                continue
+            val = ty._decode(value, trusted)
+            if is_list:
+                kwargs[name].append(val)
+            elif name in kwargs:
+                raise AttributeError(
+                    f"{name} is not a list but value already assigned to {kwargs[name]}"
+                )
             else:
                 kwargs[name] = val
-            data = data[4 + typelen :]
 
+        if unknown:
+            kwargs["unknown"] = unknown
+        if trusted:
+            return codec.construct(kwargs)
         return subcls(**kwargs)
 
     def merge_from(self, other):
         assert type(self) == type(other)
-        for name, ty in get_annotations(type(self)).items():
+        self.unknown.extend(other.unknown)
+        for name, is_list in self._codec().fields:
             new = getattr(other, name)
             if new is None:
                 continue
             old = getattr(self, name)
-            if get_origin(ty) is list:
+            if is_list:
                 old.extend(new)
                 continue
             if old is not None:
@@ -1179,6 +1650,45 @@ class WppCmd(BaseModel, ABC):
             setattr(self, name, new)
 
 
+_CMD_CODECS: Dict[typing.Type[WppCmd], "_CmdCodec"] = {}
+
+_CMD_HEADER = struct.Struct(">BHH")
+
+
+class _CmdCodec(_Constructor):
+    """Field plan for a WppCmd subclass, built once from its annotations"""
+
+    def __init__(self, cls: typing.Type[WppCmd]):
+        super().__init__(cls)
+        self.fields: List[Tuple[str, bool]] = []
+        # reverse raw type ID -> (name, is_list, bulk, WppType) map
+        self.type_map: Dict[int, Tuple[str, bool, bool, typing.Type[WppType]]] = {}
+        # name -> (raw type ID, is_list, bulk, WppType)
+        self.by_name: Dict[str, Tuple[int, bool, bool, typing.Type[WppType]]] = {}
+        # the frame for the command built without arguments, once serialized
+        self.empty_frame: Optional[bytes] = None
+        self.list_factories: List[Tuple[str, Callable]] = []
+
+        for name, ty in get_annotations(cls).items():
+            origin = get_origin(ty)
+            is_list = origin is list or origin is TlvArray
+            if origin is Union or is_list:
+                ty = get_args(ty)[0]
+            if not (isinstance(ty, type) and issubclass(ty, WppType)):
+                # not carried as a TLV, e.g. RawCmd.cmd
+                continue
+            self.fields.append((name, is_list))
+            self.type_map[ty.ID().value] = (name, is_list, origin is TlvArray, ty)
+            self.by_name[name] = (ty.ID().value, is_list, origin is TlvArray, ty)
+            if origin is TlvArray:
+                self.list_factories.append((name, functools.partial(TlvArray, ty)))
+            elif is_list:
+                self.list_factories.append((name, list))
+
+    def new_lists(self) -> Dict[str, typing.Any]:
+        return {name: factory() for name, factory in self.list_factories}
+
+
 class CmdProbe(WppCmd):
     # AppProbe
     # AppProbeOsVersion
@@ -1237,7 +1747,7 @@ class CmdDebugDump(WppCmd):
     anchor: Optional[DebugDumpAnchor] = None
     read_mode: Optional[RawDataReadMode] = None
     type: Optional[DebugDumpType] = None
-    data: List[DebugDumpData] = list()
+    data: TlvArray[DebugDumpData] = TlvArray(DebugDumpData)
     null: Optional[Null] = None
 
     @staticmethod
@@ -1265,7 +1775,7 @@ class CmdBatteryPercent(WppCmd):
 class CmdSpiFlash(WppCmd):
     cmd: Optional[SpiFlashCmd] = None
 
-    chunks: List[SpiFlashChunk] = list()
+    chunks: TlvArray[SpiFlashChunk] = TlvArray(SpiFlashChunk)
     null: Optional[Null] = None
 
     @staticmethod
@@ -1282,6 +1792,17 @@ class CmdSwimStatus(WppCmd):
         return Cmd.CMD_SWIM_STATUS_SET
 
 
+class CmdMtuExch(WppCmd):
+    wpp: Optional[MtuWpp] = None
+    att_ble: Optional[MtuAttBle] = None
+    tls: Optional[MtuTls] = None
+    null: Optional[Null] = None
+
+    @staticmethod
+    def ID() -> Cmd:
+        return Cmd.CMD_MTU_EXCH
+
+
 class CmdError(WppCmd):
     error: WppError
 
@@ -1289,4 +1810,190 @@ class CmdError(WppCmd):
     def ID() -> Cmd:
         return Cmd.CMD_ERROR
 
+
+class RawCmd(WppCmd):
+    """A command with no WppCmd here, all of its TLVs end up in unknown"""
+
+    cmd: UINT16
+
+    def ID(self) -> Union[Cmd, int]:
+        try:
+            return Cmd(self.cmd)
+        except ValueError:
+            return self.cmd
+
+    def __repr_args__(self):
+        yield "cmd", self.ID()
+        yield "unknown", self.unknown
+
+
+class LazyCmd:
+    """A received frame whose TLVs are only decoded when accessed
+
+    The TLV offsets are indexed up front, then reading an attribute named
+    like a field of the matching WppCmd decodes just that field.  Checking
+    e.g. lazy.null or Type.TYPE_NULL in lazy for the end of a multi-frame
+    response costs no more than the index.
+    """
+
+    def __init__(self, data: Buffer, trusted: bool = True):
+        self.cmd, l, self.slave_req = WppCmd._decode_header(data)
+        assert l == len(data)
+        # the frame may be a view into a receive buffer, so keep our own copy
+        self.data = bytes(data)
+        self.trusted = trusted
+        self.cls = WppCmd.CMD_ID_MAP.get(self.cmd, RawCmd)
+
+        # raw type ID -> [(offset, length)] of its values
+        self.index: Dict[int, List[Tuple[int, int]]] = {}
+        off = 5
+        while off < l:
+            typeid, typelen = struct.unpack_from(">HH", self.data, off)
+            off += 4
+            self.index.setdefault(typeid, []).append((off, typelen))
+            off += typelen
+
+    def ID(self) -> Union[Cmd, int]:
+        try:
+            return Cmd(self.cmd)
+        except ValueError:
+            return self.cmd
+
+    def __contains__(self, ty: Union[Type, int]) -> bool:
+        return (ty.value if isinstance(ty, Type) else ty) in self.index
+
+    def __getattr__(self, name: str) -> typing.Any:
+        # copy.copy() and pickle look attributes up before __init__ has run
+        cls = self.__dict__.get("cls")
+        if cls is None or name.startswith("_"):
+            raise AttributeError(name)
+        field = cls._codec().by_name.get(name)
+        if field is None:
+            raise AttributeError(f"{cls.__name__} has no field {name}")
+
+        typeid, is_list, bulk, ty = field
+        view = memoryview(self.data)
+        values = [view[off : off + l] for off, l in self.index.get(typeid, ())]
+        if bulk:
+            val = TlvArray(ty)
+            for value in values:
+                val.append_tlv(value)
+        elif is_list:
+            val = [ty._decode(value, self.trusted) for value in values]
+        elif values:
+            val = ty._decode(values[0], self.trusted)
+        else:
+            val = None
+
+        # cache it, __getattr__ won't be called for this name again
+        self.__dict__[name] = val
+        return val
+
+    def decode(self) -> WppCmd:
+        return WppCmd.deserialize(self.data, self.trusted)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        types = ", ".join(f"{typeid:#06x}" for typeid in self.index)
+        return f"LazyCmd({self.ID()}, {len(self.data)} bytes, types=[{types}])"
+
+
+class DecodeFilter:
+    """Which commands and types a session cares about
+
+    Frames for other commands aren't decoded at all, TLVs of other types are
+    skipped.  Decoding is trusted, so skipped fields are simply left unset.
+    Null and CMD_ERROR's error are always kept, without them a response
+    would never end or could not be matched to its request.
+    """
+
+    ALWAYS = frozenset((Type.TYPE_NULL.value, Type.TYPE_CMDERROR.value))
+
+    def __init__(
+        self,
+        cmds: Optional[typing.Iterable[Cmd]] = None,
+        types: Optional[typing.Iterable[Type]] = None,
+    ):
+        self.cmds = None if cmds is None else frozenset(cmd.value for cmd in cmds)
+        self.types = None if types is None else frozenset(ty.value for ty in types) | self.ALWAYS
+
+    def wants(self, data: Buffer) -> bool:
+        return self.cmds is None or WppCmd._decode_header(data)[0] in self.cmds
+
+    def decode(self, data: Buffer) -> Optional[WppCmd]:
+        if not self.wants(data):
+            return None
+        return WppCmd.deserialize(data, trusted=True, types=self.types)
+
+
+################# FRAMING #################
+
+
+class WppFramer:
+    """Splits a stream of notification fragments into complete WPP frames
+
+    Each frame is yielded as a memoryview into the framer's own buffer, which
+    is only valid until the next call to feed().  A bad frame flag raises
+    ValueError and drops everything buffered, framing starts over with the
+    next feed().
+    """
+
+    HEADER = struct.Struct(">BHH")
+
+    def __init__(self):
+        self.buf = bytearray()
+        # start of the first frame not yet emitted
+        self.off = 0
+        self.bytes_received = 0
+        self.frames_emitted = 0
+
+    @property
+    def bytes_buffered(self) -> int:
+        return len(self.buf) - self.off
+
+    def _compact(self):
+        if not self.off:
+            return
+        try:
+            # cheap on a bytearray, it just moves the start
+            del self.buf[: self.off]
+        except BufferError:
+            # somebody held on to a frame, leave them the old buffer
+            self.buf = self.buf[self.off :]
+        self.off = 0
+
+    def feed(self, data: Buffer) -> typing.Iterator[memoryview]:
+        self._compact()
+        try:
+            self.buf += data
+        except BufferError:
+            self.buf = self.buf + data
+        self.bytes_received += len(data)
+        return self._frames()
+
+    def _frames(self) -> typing.Iterator[memoryview]:
+        view = memoryview(self.buf)
+        end = len(view)
+        while end - self.off >= self.HEADER.size:
+            flag, _, l = self.HEADER.unpack_from(view, self.off)
+            if flag != 1:
+                # no way to find the next frame start in what is left
+                self.off = end
+                raise ValueError(f"bad WPP frame flag 0x{flag:02x}")
+            l += self.HEADER.size
+            if end - self.off < l:
+                break
+
+            frame = view[self.off : self.off + l]
+            # consumed even if the caller fails to decode it
+            self.off += l
+            self.frames_emitted += 1
+            yield frame
+
+    def reset(self):
+        self.buf = bytearray()
+        self.off = 0
+
 # self tests containing device secrets removed
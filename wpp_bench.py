@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+"""Micro/macro benchmarks for the wpp.py codec
+
+Every frame is synthetic (random challenges, fake MACs and versions) so the
+corpus can be shared without leaking device secrets.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+import json
+from pathlib import Path
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Annotated, Callable, Dict, List, Optional, Tuple, get_args, get_origin
+from inspect import get_annotations
+
+from wpp import (
+    BatteryPercent,
+    BatteryStatus,
+    BatteryVoltage,
+    CmdBatteryPercent,
+    CmdBatteryStatus,
+    CmdDebugDump,
+    CmdDebugDumpAck,
+    CmdDebugSet,
+    CmdDisconnect,
+    CmdError,
+    CmdMtuExch,
+    CmdProbe,
+    CmdProbeChallenge,
+    CmdSpiFlash,
+    CmdSwimStatus,
+    CmdTrackerUserGet,
+    DebugDumpAnchor,
+    DebugDumpData,
+    DebugDumpMask,
+    DebugDumpType,
+    DebugDumpTypeEnum,
+    DebugMask,
+    FactoryState,
+    LazyCmd,
+    MtuWpp,
+    Null,
+    ProbeChallenge,
+    ProbeChallengeResponse,
+    ProbeReply,
+    RawDataReadMode,
+    RawDataReadModeEnum,
+    SpiFlashChunk,
+    SpiFlashCmd,
+    SwimStatus,
+    TlvArray,
+    TrackerUser,
+    Type,
+    WppCmd,
+    WppError,
+    WppErrorEnum,
+    WppType,
+)
+
+FAKE_MAC = "00:24:e4:00:00:01"
+
+# a single frame has a 16 bit length, 3000 * 21 bytes is about as large as it gets
+BIG_CHUNKS = 3000
+# roughly what fits in one notification at a 247 byte MTU
+MTU_CHUNKS = 11
+
+# seconds for a fresh interpreter to import wpp and round trip the first
+# frames of a sync, together.  Medians measured 190-280 ms, most of it
+# importing pydantic and building the schemas
+STARTUP_BUDGET = 0.3
+
+# responses a sync decodes first, see corpus()
+STARTUP_FRAMES = ("probe_challenge", "probe_reply", "spi_flash_mtu", "debug_dump_last", "error")
+
+STARTUP_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import wpp
+t1 = time.perf_counter()
+for cmd in (
+    wpp.CmdProbe(),
+    wpp.CmdSpiFlash(cmd=wpp.SpiFlashCmd(addr=0, len=0x100)),
+    wpp.CmdDebugDump(anchor=wpp.DebugDumpAnchor(value=0)),
+):
+    cmd.serialize()
+for frame in {frames!r}:
+    wpp.WppCmd.deserialize(bytes.fromhex(frame), trusted=True)
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+"""
+
+
+def corpus(rng: random.Random) -> Dict[str, WppCmd]:
+    def rand(n: int) -> bytes:
+        return rng.randbytes(n)
+
+    return {
+        "probe": CmdProbe(),
+        "probe_reply": CmdProbe(
+            response=ProbeChallengeResponse(answer=rand(20)),
+            reply=ProbeReply(
+                vid=0,
+                pid=0,
+                name="ScanWatch",
+                mac=FAKE_MAC,
+                secret=rand(8).hex(),
+                hard_version=0xFFFFFF,
+                mfg_id="001F0080",
+                bl_version=6,
+                soft_version=2741,
+                rescue_version=0xFFFFFF,
+            ),
+            factory_state=FactoryState(value=0),
+        ),
+        "probe_challenge": CmdProbeChallenge(
+            response=ProbeChallengeResponse(answer=rand(20)),
+            challenge=ProbeChallenge(mac=FAKE_MAC, challenge=rand(16)),
+        ),
+        "tracker_user": CmdTrackerUserGet(
+            user=TrackerUser(
+                uid=1234,
+                weight_g=70000,
+                height_cm=175,
+                gender=0,
+                birth=datetime(1990, 1, 1),
+                first_name="Test",
+            )
+        ),
+        "disconnect": CmdDisconnect(null=Null()),
+        "battery_status": CmdBatteryStatus(
+            status=BatteryStatus(percent=80, state=1, mv=3950, reserved=0)
+        ),
+        "battery_percent": CmdBatteryPercent(
+            percent=BatteryPercent(percent=80), voltage=BatteryVoltage(mv=3950)
+        ),
+        "debug_set": CmdDebugSet(
+            mask=DebugDumpMask(mask=DebugMask.DBLIB_DUMP | DebugMask.WLOG), null=Null()
+        ),
+        "debug_dump_data": CmdDebugDump(
+            data=[DebugDumpData(buf=rand(64)) for _ in range(3)],
+        ),
+        "debug_dump_last": CmdDebugDump(
+            type=DebugDumpType(type=DebugDumpTypeEnum.WLOG, size=4096),
+            read_mode=RawDataReadMode(mode=RawDataReadModeEnum.WPP_RAW_DATA_READ_ALL),
+            data=[DebugDumpData(buf=rand(64)) for _ in range(2)],
+            anchor=DebugDumpAnchor(value=1),
+            null=Null(),
+        ),
+        "debug_dump_ack": CmdDebugDumpAck(null=Null()),
+        "mtu_exch": CmdMtuExch(wpp=MtuWpp(mtu=244), null=Null()),
+        "spi_flash_cmd": CmdSpiFlash(cmd=SpiFlashCmd(addr=0x6000, len=0x2000)),
+        "spi_flash_mtu": CmdSpiFlash(
+            chunks=[SpiFlashChunk(data=rand(16)) for _ in range(MTU_CHUNKS)]
+        ),
+        "spi_flash_big": CmdSpiFlash(
+            chunks=[SpiFlashChunk(data=rand(16)) for _ in range(BIG_CHUNKS)], null=Null()
+        ),
+        "swim_status": CmdSwimStatus(status=SwimStatus(enabled=1), null=Null()),
+        "error": CmdError(error=WppError(cmd=2386, err=WppErrorEnum.DEVBUSY)),
+    }
+
+
+def reflective_deserialize(data: bytes) -> WppCmd:
+    """The annotation walking decoder wpp.py used before field plans
+
+    Kept only as a point of comparison for the compiled codec.
+    """
+
+    def size_from_metadata(ty) -> Tuple[int, bool]:
+        return WppType._size_from_metadata(ty)
+
+    def decode_type(subcls, data: bytes) -> WppType:
+        kwargs = {}
+        for name, ty in get_annotations(subcls).items():
+            real_type = get_args(ty)[0] if get_origin(ty) is Annotated else ty
+            if issubclass(real_type, bytes):
+                size = data[0] + 1
+                kwargs[name] = data[1:size]
+            elif issubclass(real_type, int):
+                size, signed = size_from_metadata(ty)
+                kwargs[name] = int.from_bytes(data[:size], "big", signed=signed)
+            elif issubclass(real_type, datetime):
+                size = 4
+                kwargs[name] = datetime.utcfromtimestamp(int.from_bytes(data[:size], "big"))
+            else:
+                size = data[0] + 1
+                kwargs[name] = data[1:size].decode()
+            data = data[size:]
+        return subcls(**kwargs)
+
+    cmd, l, _ = WppCmd.decode_header(data)
+    data = data[5:]
+    subcls = WppCmd.CMD_MAP[cmd]
+    kwargs = {}
+    type_map = {}
+    for name, ty in get_annotations(subcls).items():
+        origin = get_origin(ty)
+        if origin is not None and origin is not Annotated:
+            ty = get_args(ty)[0]
+            if origin is list or origin is TlvArray:
+                kwargs[name] = list()
+        type_map[ty.ID()] = name
+
+    while data:
+        typeid, typelen = struct.unpack_from(">HH", data)
+        typeid = Type(typeid)
+        val = decode_type(WppType.TYPE_MAP[typeid], data[4 : 4 + typelen])
+        name = type_map[typeid]
+        if isinstance(kwargs.get(name), list):
+            kwargs[name].append(val)
+        else:
+            kwargs[name] = val
+        data = data[4 + typelen :]
+
+    return subcls(**kwargs)
+
+
+@dataclass
+class Result:
+    name: str
+    op: str
+    frames: int
+    seconds: float
+    frame_bytes: int
+    # peak bytes traced during one call, temporaries included
+    peak_bytes_per_frame: float
+
+    @property
+    def frames_per_sec(self) -> float:
+        return self.frames / self.seconds
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.frames * self.frame_bytes / self.seconds / 1e6
+
+
+def measure(name: str, op: str, fn: Callable[[], object], frame_bytes: int, min_time: float) -> Result:
+    # warm up, this also compiles the codec plans
+    fn()
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    # memory is traced on a separate, smaller run as tracing is slow.  The
+    # peak above what was allocated before the call includes temporary
+    # copies freed before it returns, not just the result.
+    sample = max(1, min(number, 200))
+    peak = 0
+    tracemalloc.start()
+    for _ in range(sample):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return Result(name, op, number, elapsed, frame_bytes, peak / sample)
+
+
+def run(names: Optional[List[str]], ops: Optional[List[str]], min_time: float, merge_frames: int) -> List[Result]:
+    cmds = corpus(random.Random(0))
+    missing = set(WppCmd.CMD_MAP.values()) - {type(cmd) for cmd in cmds.values()}
+    if missing:
+        print(f"no synthetic frame for: {', '.join(cls.__name__ for cls in missing)}", file=sys.stderr)
+
+    results = []
+
+    def bench(name: str, op: str, fn: Callable[[], object], frame_bytes: int):
+        if ops and op not in ops:
+            return
+        results.append(measure(name, op, fn, frame_bytes, min_time))
+
+    for name, cmd in cmds.items():
+        if names and name not in names:
+            continue
+        data = cmd.serialize()
+        assert WppCmd.deserialize(data) == cmd, name
+        bench(name, "serialize", cmd.serialize, len(data))
+        bench(name, "deserialize", lambda: WppCmd.deserialize(data), len(data))
+        bench(name, "deserialize_trusted", lambda: WppCmd.deserialize(data, trusted=True), len(data))
+        bench(name, "lazy_index", lambda: LazyCmd(data), len(data))
+        bench(name, "reflective", lambda: reflective_deserialize(data), len(data))
+
+    # multi-frame responses, as drained by transact_until_null()
+    for name in ("spi_flash_mtu", "debug_dump_data"):
+        if names and name not in names:
+            continue
+        data = cmds[name].serialize()
+
+        def merge():
+            rsp = WppCmd.deserialize(data, trusted=True)
+            for _ in range(merge_frames - 1):
+                rsp.merge_from(WppCmd.deserialize(data, trusted=True))
+            return rsp
+
+        bench(f"{name}x{merge_frames}", "merge_from", merge, len(data) * merge_frames)
+
+    return results
+
+
+def parse_importtime(stderr: str, package: str) -> Tuple[float, List[Tuple[str, float]]]:
+    """Self time of package and cumulative time of what it imports directly"""
+    # -X importtime prints children before their parent, indented two more
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((depth, name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+
+    for i, (depth, name, self_s, _) in enumerate(entries):
+        if name != package:
+            continue
+        children = []
+        for child_depth, child, _, cumulative in reversed(entries[:i]):
+            if child_depth <= depth:
+                break
+            if child_depth == depth + 1:
+                children.append((child, cumulative))
+        return self_s, sorted(children, key=lambda c: -c[1])
+
+    return 0.0, []
+
+
+def startup(runs: int) -> Tuple[float, float]:
+    here = Path(__file__).resolve().parent
+    cmds = corpus(random.Random(0))
+    script = STARTUP_SCRIPT.format(frames=[cmds[name].serialize().hex() for name in STARTUP_FRAMES])
+    imports, first_frames = [], []
+    for i in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", script],
+            cwd=here,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        import_s, first_frame_s = map(float, proc.stdout.split())
+        imports.append(import_s)
+        first_frames.append(first_frame_s)
+        if i == 0:
+            self_s, children = parse_importtime(proc.stderr, "wpp")
+            print(f"{'wpp (self)':40s} {self_s * 1e3:8.1f} ms")
+            for name, cumulative in children[:10]:
+                print(f"  {name:38s} {cumulative * 1e3:8.1f} ms")
+
+    import_s = statistics.median(imports)
+    first_frame_s = statistics.median(first_frames)
+    print(f"{'import wpp':40s} {import_s * 1e3:8.1f} ms (median of {runs})")
+    print(f"{'first round trips':40s} {first_frame_s * 1e3:8.1f} ms")
+    print(f"{'total':40s} {(import_s + first_frame_s) * 1e3:8.1f} ms")
+    return import_s, first_frame_s
+
+
+def report(results: List[Result], baseline: Optional[Dict[str, float]]):
+    print(f"{'frame':24s} {'op':20s} {'bytes':>7s} {'frames/s':>11s} {'MB/s':>8s} {'peak B':>8s}")
+    for r in results:
+        line = (
+            f"{r.name:24s} {r.op:20s} {r.frame_bytes:7d} {r.frames_per_sec:11.0f} "
+            f"{r.mb_per_sec:8.2f} {r.peak_bytes_per_frame:8.0f}"
+        )
+        old = (baseline or {}).get(f"{r.name}/{r.op}")
+        if old:
+            line += f"  {r.frames_per_sec / old - 1:+.0%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frame", action="append", help="only these corpus entries")
+    parser.add_argument("--op", action="append", help="only these operations")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("--merge-frames", type=int, default=2048)
+    parser.add_argument("--save", type=Path, help="write frames/s per benchmark as JSON")
+    parser.add_argument("--compare", type=Path, help="JSON written by --save to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="with --compare, fail when a benchmark is this much slower",
+    )
+    parser.add_argument(
+        "--startup", type=int, metavar="RUNS", help="only measure import and first frame cost"
+    )
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET, help="seconds")
+    args = parser.parse_args()
+
+    if args.startup:
+        import_s, first_frame_s = startup(args.startup)
+        if import_s + first_frame_s > args.startup_budget:
+            print(f"over the startup budget of {args.startup_budget * 1e3:.0f} ms")
+            sys.exit(1)
+        sys.exit(0)
+
+    results = run(args.frame, args.op, args.min_time, args.merge_frames)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    report(results, baseline)
+
+    if args.save:
+        args.save.write_text(
+            json.dumps({f"{r.name}/{r.op}": r.frames_per_sec for r in results}, indent=2)
+        )
+
+    if baseline:
+        slower = [
+            f"{r.name}/{r.op}"
+            for r in results
+            if baseline.get(f"{r.name}/{r.op}")
+            and r.frames_per_sec < baseline[f"{r.name}/{r.op}"] * (1 - args.tolerance)
+        ]
+        if slower:
+            print(f"regressed: {', '.join(slower)}")
+            sys.exit(1)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Binary captures of the raw fragments of a WPP session
+
+A capture starts with MAGIC and the wall clock time it was opened at (as a
+big endian float64), followed by one record per fragment:
+
+    u8   direction (TX = 0, RX = 1)
+    u64  nanoseconds since the capture was opened (monotonic)
+    u32  length
+         data
+
+CaptureTransport records everything passing through another Transport,
+replay() feeds a capture back through the framer and codec.
+"""
+
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Tuple
+
+from transport import Transport
+from wpp import WppCmd, WppFramer
+
+
+MAGIC = b"WPPCAP\x00\x01"
+TX = 0
+RX = 1
+
+_START = struct.Struct(">d")
+_RECORD = struct.Struct(">BQI")
+
+
+class Record(NamedTuple):
+    direction: int
+    # seconds since the capture was opened
+    time: float
+    data: bytes
+
+
+class CaptureWriter:
+    """Appends records to a capture file, buffered so it can stay on"""
+
+    def __init__(self, path: os.PathLike, buffering: int = 1 << 16):
+        self.f: BinaryIO = open(path, "wb", buffering=buffering)
+        self.f.write(MAGIC + _START.pack(time.time()))
+        self.start = time.monotonic_ns()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, direction: int, data: bytes):
+        self.f.write(_RECORD.pack(direction, time.monotonic_ns() - self.start, len(data)))
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CaptureTransport(Transport):
+    """Passes everything through to inner, recording each fragment"""
+
+    def __init__(self, inner: Transport, writer: CaptureWriter):
+        super().__init__()
+        self.inner = inner
+        self.writer = writer
+        inner.on_receive = self._received
+        inner.on_disconnect = lambda exc: self.on_disconnect(exc)
+
+    @property
+    def mtu(self) -> int:
+        return self.inner.mtu
+
+    @property
+    def connected(self) -> bool:
+        return self.inner.connected
+
+    async def start(self):
+        await self.inner.start()
+
+    async def stop(self):
+        await self.inner.stop()
+        self.writer.flush()
+
+    async def send(self, data: bytes, response: bool = True):
+        self.writer.write(TX, data)
+        await self.inner.send(data, response)
+
+    def lost(self, exc: Optional[BaseException] = None):
+        self.inner.lost(exc)
+
+    def _received(self, data: bytes):
+        self.writer.write(RX, data)
+        self.on_receive(data)
+
+
+def read_capture(path: os.PathLike) -> Tuple[float, Iterator[Record]]:
+    """Returns the wall clock time the capture started at and its records"""
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC) + _START.size)
+    if head[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a WPP capture")
+    (started,) = _START.unpack_from(head, len(MAGIC))
+
+    def records() -> Iterator[Record]:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = len(head)
+            end = len(m)
+            while pos + _RECORD.size <= end:
+                direction, ns, length = _RECORD.unpack_from(m, pos)
+                pos += _RECORD.size
+                if pos + length > end:
+                    # cut short while being written
+                    break
+                yield Record(direction, ns / 1e9, m[pos : pos + length])
+                pos += length
+
+    return started, records()
+
+
+def replay(path: os.PathLike, direction: int = RX, trusted: bool = True) -> Iterator[Tuple[float, WppCmd]]:
+    """Decodes the frames sent in direction as fast as possible, with the time of their last fragment"""
+    framer = WppFramer()
+    _, records = read_capture(path)
+    for record in records:
+        if record.direction != direction:
+            continue
+        for frame in framer.feed(record.data):
+            yield record.time, WppCmd.deserialize(frame, trusted=trusted)
+
+
+async def play(path: os.PathLike, transport: Transport, speed: float = 1.0):
+    """Delivers the RX fragments of a capture to transport.on_receive at the recorded pace
+
+    speed scales the pace, e.g. 2.0 replays twice as fast.
+    """
+    _, records = read_capture(path)
+    start = time.monotonic()
+    for record in records:
+        if record.direction != RX:
+            continue
+        delay = start + record.time / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        transport.on_receive(record.data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="print or benchmark a WPP capture")
+    parser.add_argument("capture", type=Path)
+    parser.add_argument("--validate", action="store_true", help="decode with full validation")
+    parser.add_argument("--bench", action="store_true", help="only report decode throughput")
+    args = parser.parse_args()
+
+    if args.bench:
+        _, records = read_capture(args.capture)
+        size = sum(len(r.data) for r in records if r.direction == RX)
+        t0 = time.perf_counter()
+        frames = sum(1 for _ in replay(args.capture, trusted=not args.validate))
+        dt = time.perf_counter() - t0
+        print(f"{frames} frames, {size} bytes in {dt * 1000:.1f} ms: {frames / dt:.0f} frames/s, {size / dt / 1e6:.1f} MB/s")
+        return
+
+    _, records = read_capture(args.capture)
+    framers = {TX: WppFramer(), RX: WppFramer()}
+    for record in records:
+        for frame in framers[record.direction].feed(record.data):
+            cmd = WppCmd.deserialize(frame, trusted=not args.validate)
+            print(f"{record.time:10.4f} {'TX' if record.direction == TX else 'RX'} {cmd!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Latency and throughput counters for a WppSession
+
+Everything is kept in plain counters and fixed bucket histograms, cheap enough
+to leave on.  snapshot() gives a JSON friendly dict, prometheus() the text
+exposition format for e.g. node_exporter's textfile collector.
+"""
+
+import asyncio
+import bisect
+import contextlib
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fileutil import write_atomic
+
+# seconds, a BLE connection interval is 7.5 ms at best
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> Iterator[Tuple[str, int]]:
+        total = 0
+        for le, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            yield ("+Inf" if le == float("inf") else repr(le)), total
+
+    def snapshot(self) -> dict:
+        return {"buckets": dict(self.cumulative()), "sum": self.sum, "count": self.count}
+
+
+def _labels(**labels: str) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+class SessionMetrics:
+    """Counters a WppSession updates as frames go by
+
+    Histograms are keyed by the Cmd name of the request:
+      rtt           send to response, single frame requests
+      first_frame   send to first response frame, multi frame requests
+      until_null    send to the frame carrying Null, multi frame requests
+      operation     named spans timed with time(), e.g. the probe handshake
+    """
+
+    def __init__(self):
+        self.frames = {"tx": 0, "rx": 0}
+        self.bytes = {"tx": 0, "rx": 0}
+        # CPU time of the thread receiving
+        self.decode_seconds = 0.0
+        self.errors: Dict[Tuple[str, str], int] = {}
+        self.rtt: Dict[str, Histogram] = {}
+        self.first_frame: Dict[str, Histogram] = {}
+        self.until_null: Dict[str, Histogram] = {}
+        self.operation: Dict[str, Histogram] = {}
+        # requests awaiting a response
+        self.pending = 0
+        self.pending_max = 0
+        # the session's queue of frames nobody asked for
+        self.unsolicited_queue: Optional[asyncio.Queue] = None
+
+    @property
+    def unsolicited(self) -> int:
+        """Frames nobody asked for still waiting to be read"""
+        return 0 if self.unsolicited_queue is None else self.unsolicited_queue.qsize()
+
+    @staticmethod
+    def _observe(hists: Dict[str, Histogram], key: str, value: float):
+        hist = hists.get(key)
+        if hist is None:
+            hist = hists[key] = Histogram()
+        hist.observe(value)
+
+    def sent(self, size: int, pending: int):
+        self.frames["tx"] += 1
+        self.bytes["tx"] += size
+        self.pending = pending
+        self.pending_max = max(self.pending_max, pending)
+
+    def received(self, size: int, decode_seconds: float):
+        self.frames["rx"] += 1
+        self.bytes["rx"] += size
+        self.decode_seconds += decode_seconds
+
+    def response(self, cmd: str, seconds: float, multi: bool, first: bool, last: bool):
+        """A response frame arrived seconds after its request was sent"""
+        if not multi:
+            self._observe(self.rtt, cmd, seconds)
+            return
+        if first:
+            self._observe(self.first_frame, cmd, seconds)
+        if last:
+            self._observe(self.until_null, cmd, seconds)
+
+    def error(self, cmd: str, err: str):
+        self.errors[cmd, err] = self.errors.get((cmd, err), 0) + 1
+
+    @contextlib.contextmanager
+    def time(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(self.operation, name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        return {
+            "frames": dict(self.frames),
+            "bytes": dict(self.bytes),
+            "decode_seconds": self.decode_seconds,
+            "errors": [{"cmd": cmd, "err": err, "count": n} for (cmd, err), n in self.errors.items()],
+            "pending": self.pending,
+            "pending_max": self.pending_max,
+            "unsolicited": self.unsolicited,
+            "rtt": {k: h.snapshot() for k, h in self.rtt.items()},
+            "first_frame": {k: h.snapshot() for k, h in self.first_frame.items()},
+            "until_null": {k: h.snapshot() for k, h in self.until_null.items()},
+            "operation": {k: h.snapshot() for k, h in self.operation.items()},
+        }
+
+    def prometheus(self, prefix: str = "wpp", **labels: str) -> str:
+        """Text exposition format, labels are added to every sample (e.g. device=...)"""
+        lines: List[str] = []
+        base = _labels(**labels)
+
+        def sample(name: str, value: float, **extra: str):
+            all_labels = ",".join(filter(None, (base, _labels(**extra))))
+            lines.append(f"{prefix}_{name}{{{all_labels}}} {value}" if all_labels else f"{prefix}_{name} {value}")
+
+        def header(name: str, kind: str, help: str):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        header("frames_total", "counter", "WPP frames by direction")
+        for direction, n in self.frames.items():
+            sample("frames_total", n, direction=direction)
+        header("bytes_total", "counter", "WPP frame bytes by direction")
+        for direction, n in self.bytes.items():
+            sample("bytes_total", n, direction=direction)
+        header("decode_seconds_total", "counter", "CPU time spent decoding received frames")
+        sample("decode_seconds_total", self.decode_seconds)
+        header("errors_total", "counter", "CMD_ERROR responses by request and error")
+        for (cmd, err), n in self.errors.items():
+            sample("errors_total", n, cmd=cmd, err=err)
+        header("pending_requests", "gauge", "Requests awaiting a response")
+        sample("pending_requests", self.pending)
+        header("pending_requests_max", "gauge", "Most requests awaiting a response at once")
+        sample("pending_requests_max", self.pending_max)
+        header("unsolicited_frames", "gauge", "Frames nobody asked for still queued")
+        sample("unsolicited_frames", self.unsolicited)
+
+        for name, hists, help, key in (
+            ("rtt_seconds", self.rtt, "Request to response time", "cmd"),
+            ("first_frame_seconds", self.first_frame, "Request to first frame of a multi frame response", "cmd"),
+            ("until_null_seconds", self.until_null, "Request to the Null frame of a multi frame response", "cmd"),
+            ("operation_seconds", self.operation, "Duration of timed operations", "op"),
+        ):
+            header(name, "histogram", help)
+            for label, hist in hists.items():
+                for le, n in hist.cumulative():
+                    sample(f"{name}_bucket", n, **{key: label, "le": le})
+                sample(f"{name}_sum", hist.sum, **{key: label})
+                sample(f"{name}_count", hist.count, **{key: label})
+
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: os.PathLike):
+        write_atomic(path, json.dumps(self.snapshot(), indent=1))
+
+    def write_prometheus(self, path: os.PathLike, **labels: str):
+        # renamed into place so a collector never reads half a file
+        write_atomic(path, self.prometheus(**labels))
@@ -0,0 +1,601 @@
+import asyncio
+import logging
+import secrets
+import time
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from wpp import (
+    Cmd,
+    CmdError,
+    CmdMtuExch,
+    CmdProbe,
+    CmdProbeChallenge,
+    DecodeFilter,
+    LazyCmd,
+    MtuWpp,
+    ProbeChallenge,
+    TlvArray,
+    Type,
+    WppCmd,
+    WppErrorEnum,
+    WppFramer,
+    WppType,
+)
+from transport import Transport
+from wpp_metrics import SessionMetrics
+from wpp_trace import FrameTrace, cmd_name
+
+
+logger = logging.getLogger(__name__)
+
+
+class WppErrorResponse(Exception):
+    """The device answered a command with CMD_ERROR"""
+
+    def __init__(self, rsp: CmdError):
+        super().__init__(rsp)
+        self.rsp = rsp
+        self.error = rsp.error
+
+
+def _err_name(err: Union[WppErrorEnum, int]) -> str:
+    # errors newer firmware added decode as plain ints
+    return err.name if isinstance(err, WppErrorEnum) else str(err)
+
+
+class _Pending:
+    """A request waiting for its response frame(s)"""
+
+    def __init__(self, name: str, cmds: FrozenSet[int], multi: bool):
+        # Cmd name of the request, for metrics
+        self.name = name
+        # raw command IDs the response may come back as
+        self.cmds = cmds
+        # keep receiving until a frame carries Null
+        self.multi = multi
+        self.queue: asyncio.Queue[Union[WppCmd, BaseException]] = asyncio.Queue()
+        self.sent = time.perf_counter()
+        self.frames = 0
+        # when its last frame arrived
+        self.last = self.sent
+        # the last response frame has been queued
+        self.done = False
+        # given up on, its remaining frames are dropped
+        self.draining = False
+
+
+def bulk(frame: WppCmd) -> Iterator[TlvArray]:
+    """TlvArray fields of a frame, e.g. CmdSpiFlash.chunks"""
+    for name in type(frame).model_fields:
+        value = getattr(frame, name)
+        if isinstance(value, TlvArray):
+            yield value
+
+
+# a sink is called with every frame of a streamed response
+Sink = Callable[[WppCmd], None]
+
+
+class FileSink:
+    """Writes the bulk payloads of each frame to a binary file"""
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.size = 0
+
+    def __call__(self, frame: WppCmd):
+        for array in bulk(frame):
+            self.size += self.f.write(array.getbuffer())
+
+
+class BufferSink:
+    """Appends the bulk payloads of each frame to a bytearray"""
+
+    def __init__(self, buf: Optional[bytearray] = None):
+        self.buf = bytearray() if buf is None else buf
+
+    def __call__(self, frame: WppCmd):
+        for array in bulk(frame):
+            self.buf += array.getbuffer()
+
+
+class CallbackSink:
+    """Calls fn with the bulk payload of each frame"""
+
+    def __init__(self, fn: Callable[[memoryview], None]):
+        self.fn = fn
+
+    def __call__(self, frame: WppCmd):
+        for array in bulk(frame):
+            if len(array):
+                self.fn(array.getbuffer())
+
+
+class Subscription:
+    """Notifications of one type, see WppSession.subscribe()"""
+
+    def __init__(self, session: "WppSession", type_id: int):
+        self.session = session
+        # raw (u16) type ID
+        self.type_id = type_id
+        self.queue: asyncio.Queue[Union[WppType, BaseException]] = asyncio.Queue()
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> WppType:
+        return await self.get()
+
+    async def get(self, timeout: Optional[float] = None) -> WppType:
+        """Next notification, raises asyncio.TimeoutError if none arrives within timeout"""
+        value = await asyncio.wait_for(self.queue.get(), timeout)
+        if isinstance(value, BaseException):
+            raise value
+        return value
+
+    def close(self):
+        subs = self.session.subscriptions.get(self.type_id, [])
+        if self in subs:
+            subs.remove(self)
+        if not subs:
+            self.session.subscriptions.pop(self.type_id, None)
+
+
+class WppSession:
+    """WPP client over a Transport, e.g. a BleakTransport
+
+    Responses are matched to requests by command ID (CMD_ERROR by the ID it
+    reports), so several commands may be in flight on the link at once.
+    A request given up on (timed out, cancelled) keeps swallowing its
+    response until the last frame of it arrives, or none has for timeout
+    seconds (DRAIN_TIMEOUT without a timeout) and the rest is taken as lost.
+    Frames nobody is waiting for end up in unsolicited, unless they carry a
+    type somebody subscribed to.
+
+    With a DecodeFilter, frames nobody is waiting for are only decoded if
+    they are for one of its commands, and only its types of those commands
+    are decoded.  Completion is checked on the TLV index of each frame, not
+    its fields.
+
+    Outgoing frames are split into mtu sized writes.  Bulk requests go out as
+    writes without response, with an acknowledged write every window
+    fragments and at most window requests awaiting a response.
+
+    With a timeout, a request is given up on with asyncio.TimeoutError when
+    no frame of its response arrives for timeout seconds.
+    """
+
+    DRAIN_TIMEOUT = 10.0
+
+    def __init__(
+        self,
+        transport: Transport,
+        window: int = 8,
+        metrics: Optional[SessionMetrics] = None,
+        trace: Optional[FrameTrace] = None,
+        decode: Optional[DecodeFilter] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.transport = transport
+        self.decode = decode
+        self.timeout = timeout
+        self.metrics = SessionMetrics() if metrics is None else metrics
+        self.trace = FrameTrace() if trace is None else trace
+        transport.on_receive = self._on_data
+        transport.on_disconnect = self._on_disconnect
+        self.framer = WppFramer()
+        self.mtu = transport.mtu
+        self.window = window
+        # bulk fragments written since the last acknowledged write
+        self.unacked = 0
+        # in the order the requests were sent
+        self.pending: List[_Pending] = []
+        self.unsolicited: asyncio.Queue[WppCmd] = asyncio.Queue()
+        self.metrics.unsolicited_queue = self.unsolicited
+        # by raw type ID
+        self.subscriptions: Dict[int, List[Subscription]] = {}
+        self.write_lock = asyncio.Lock()
+        self.closed: Optional[BaseException] = None
+
+    async def __aenter__(self) -> "WppSession":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        await self.transport.start()
+
+    async def stop(self):
+        self.close(ConnectionError("session stopped"))
+        if self.transport.connected:
+            await self.transport.stop()
+
+    def close(self, exc: BaseException):
+        """Fails every pending request"""
+        if self.closed is None:
+            self.closed = exc
+        for pending in self.pending:
+            pending.queue.put_nowait(exc)
+        self.pending.clear()
+        for subs in self.subscriptions.values():
+            for sub in subs:
+                sub.queue.put_nowait(exc)
+
+    def _on_disconnect(self, exc: Optional[BaseException]):
+        self.close(ConnectionError("disconnected") if exc is None else exc)
+
+    def _on_data(self, data: bytes):
+        frame = b""
+        try:
+            # a notification may carry several frames, or part of one
+            for frame in self.framer.feed(data):
+                self._dispatch(frame)
+        except Exception as e:
+            logger.exception("failed to unpack %d bytes: %s", len(frame), bytes(frame).hex())
+            self.close(e)
+
+    def _dispatch(self, frame: memoryview):
+        # CPU time, so other threads and processes holding the CPU are not counted
+        start = time.thread_time()
+        # only the TLV offsets so far, fields are decoded when needed
+        lazy = LazyCmd(frame)
+        metrics = self.metrics
+        if lazy.slave_req:
+            taken = self._notify(lazy)
+            metrics.received(len(frame), time.thread_time() - start)
+            if taken:
+                self.trace.rx(frame, note=f"SLAVE_REQ | {lazy.cmd} notification")
+            else:
+                self.trace.rx(frame, note=f"ignoring SLAVE_REQ | {lazy.cmd}")
+            return
+
+        cmd_id = lazy.cmd
+        error = cmd_id == Cmd.CMD_ERROR.value
+        if error:
+            cmd_id = lazy.error.cmd
+        pending = self._match(cmd_id)
+
+        if pending is not None and pending.draining:
+            pending.frames += 1
+            pending.last = time.perf_counter()
+            pending.done = not pending.multi or error or Type.TYPE_NULL.value in lazy.index
+            metrics.received(len(frame), time.thread_time() - start)
+            self.trace.rx(frame, note=f"dropping {lazy.ID()} for abandoned {pending.name}")
+            if pending.done:
+                self.pending.remove(pending)
+                metrics.pending = len(self.pending)
+            return
+
+        decode = self.decode
+        filtered = decode is not None and (decode.cmds is None or lazy.cmd in decode.cmds)
+        if pending is None:
+            # CMD_CHANNEL_NOTIF frames and anything else nobody asked for
+            if self._notify(lazy):
+                metrics.received(len(frame), time.thread_time() - start)
+                self.trace.rx(frame, note=f"{lazy.ID()} notification")
+                return
+            if decode is not None and not filtered:
+                metrics.received(len(frame), time.thread_time() - start)
+                self.trace.rx(frame, note=f"skipping {lazy.ID()}")
+                return
+
+        types = decode.types if filtered else None
+        rsp = WppCmd.deserialize(lazy.data, trusted=True, types=types)
+        metrics.received(len(frame), time.thread_time() - start)
+        now = time.perf_counter()
+        self.trace.rx(frame, rsp)
+
+        if pending is None:
+            self.unsolicited.put_nowait(rsp)
+            return
+
+        pending.frames += 1
+        pending.last = now
+        # from the index, a multi frame response ends with the frame carrying Null
+        pending.done = not pending.multi or error or Type.TYPE_NULL.value in lazy.index
+        pending.queue.put_nowait(rsp)
+        if error:
+            metrics.error(pending.name, _err_name(rsp.error.err))
+        else:
+            metrics.response(pending.name, now - pending.sent, pending.multi, pending.frames == 1, pending.done)
+        if pending.done:
+            self.pending.remove(pending)
+            metrics.pending = len(self.pending)
+
+    def _match(self, cmd_id: int) -> Optional[_Pending]:
+        """The oldest request cmd_id answers"""
+        for pending in self.pending:
+            if cmd_id not in pending.cmds:
+                continue
+            if self._lost(pending):
+                # otherwise it would swallow the response to a later request
+                self._forget(pending, drain=False)
+                return self._match(cmd_id)
+            return pending
+        return None
+
+    def _lost(self, pending: _Pending) -> bool:
+        """A request given up on whose remaining frames aren't coming"""
+        if not pending.draining:
+            return False
+        timeout = self.DRAIN_TIMEOUT if self.timeout is None else self.timeout
+        if time.perf_counter() - pending.last <= timeout:
+            return False
+        logger.debug("%s given up on after %d frame(s), the rest was lost", pending.name, pending.frames)
+        return True
+
+    def _notify(self, lazy: LazyCmd) -> bool:
+        """Hands the TLVs of a frame to their subscribers, False if nobody took any"""
+        if not self.subscriptions:
+            return False
+        taken = False
+        view = memoryview(lazy.data)
+        for type_id, values in lazy.index.items():
+            subs = self.subscriptions.get(type_id)
+            if not subs:
+                continue
+            for off, size in values:
+                value = WppType.deserialize(type_id, view[off : off + size], trusted=True)
+                for sub in subs:
+                    sub.queue.put_nowait(value)
+            taken = True
+        return taken
+
+    def subscribe(self, ty: Union[Type, int]) -> Subscription:
+        """Receives every ty the device sends without being asked, until closed
+
+        Notifications come on the CMD_CHANNEL_NOTIF channel or as slave
+        requests, e.g. TYPE_STATUS_CHANGED or TYPE_BATTERY_STATUS.
+        """
+        type_id = (ty.value if isinstance(ty, Type) else ty) & 0xFFFF
+        sub = Subscription(self, type_id)
+        self.subscriptions.setdefault(type_id, []).append(sub)
+        return sub
+
+    def on(
+        self,
+        ty: Union[Type, int],
+        handler: Callable[[WppType], None],
+        poll: Optional[Callable[[], Awaitable[WppType]]] = None,
+        deadline: Optional[float] = None,
+    ) -> "asyncio.Task[None]":
+        """Calls handler with every ty notification until the returned task is cancelled
+
+        If no notification arrives within deadline seconds, poll() is awaited
+        for the value instead, for firmware which never sends ty.
+        """
+        sub = self.subscribe(ty)
+
+        async def run():
+            with sub:
+                while True:
+                    try:
+                        value = await sub.get(deadline)
+                    except asyncio.TimeoutError:
+                        if poll is None:
+                            continue
+                        value = await poll()
+                    handler(value)
+
+        return asyncio.create_task(run())
+
+    async def negotiate_mtu(self, timeout: float = 2.0) -> int:
+        """Agrees on the WPP MTU with the device
+
+        Falls back to the transport's if the device has no CMD_MTU_EXCH or
+        does not answer within timeout.
+        """
+        mtu = self.transport.mtu
+        try:
+            rsp = await asyncio.wait_for(self.transact(CmdMtuExch(wpp=MtuWpp(mtu=mtu))), timeout)
+        except WppErrorResponse as e:
+            logger.debug("no CMD_MTU_EXCH (%s), using transport MTU %d", _err_name(e.error.err), mtu)
+        except asyncio.TimeoutError:
+            logger.warning("no answer to CMD_MTU_EXCH, using transport MTU %d", mtu)
+        else:
+            if rsp.wpp is not None:
+                mtu = max(Transport.MIN_MTU, min(mtu, rsp.wpp.mtu))
+        self.mtu = mtu
+        return mtu
+
+    async def _write(self, data: bytes, bulk: bool = False):
+        async with self.write_lock:
+            for start in range(0, len(data), self.mtu):
+                response = True
+                if bulk:
+                    # acknowledging every window fragments keeps the device's buffers from overflowing
+                    self.unacked += 1
+                    response = self.unacked >= self.window
+                    if response:
+                        self.unacked = 0
+                await self.transport.send(data[start : start + self.mtu], response)
+
+    async def _request(self, cmd: WppCmd, expect: Optional[Iterable[Cmd]], multi: bool, bulk: bool = False) -> _Pending:
+        if self.closed is not None:
+            raise ConnectionError("session closed") from self.closed
+
+        if expect is None:
+            expect = (cmd.ID(),)
+        data = cmd.serialize()
+        self.trace.tx(data, cmd)
+
+        cmds = frozenset(c.value if isinstance(c, Cmd) else c for c in expect)
+        pending = _Pending(cmd_name(cmd.ID()), cmds, multi)
+        for old in [p for p in self.pending if self._lost(p)]:
+            self._forget(old, drain=False)
+        # registered before writing, the response may beat send() returning
+        self.pending.append(pending)
+        self.metrics.sent(len(data), len(self.pending))
+        try:
+            await self._write(data, bulk)
+        except BaseException:
+            # the device may never have seen it, nothing to drain
+            self._forget(pending, drain=False)
+            raise
+        return pending
+
+    def _forget(self, pending: _Pending, drain: bool = True):
+        if pending not in self.pending:
+            return
+        if drain:
+            # given up on before its last frame: it keeps matching until
+            # then, or the rest would be taken for the next request with the
+            # same ID
+            pending.draining = True
+            return
+        self.pending.remove(pending)
+        self.metrics.pending = len(self.pending)
+
+    async def _next(self, pending: _Pending) -> WppCmd:
+        rsp = await asyncio.wait_for(pending.queue.get(), self.timeout)
+        if isinstance(rsp, BaseException):
+            raise rsp
+        if isinstance(rsp, CmdError):
+            raise WppErrorResponse(rsp)
+        return rsp
+
+    async def transact(self, cmd: WppCmd, expect: Optional[Iterable[Cmd]] = None, bulk: bool = False) -> WppCmd:
+        """Sends cmd and returns its response
+
+        expect lists the commands the response may arrive as, by default the
+        command sent.  bulk sends it with writes without response.
+        """
+        pending = await self._request(cmd, expect, multi=False, bulk=bulk)
+        try:
+            return await self._next(pending)
+        finally:
+            self._forget(pending)
+
+    async def stream(self, cmd: WppCmd, expect: Optional[Iterable[Cmd]] = None) -> AsyncIterator[WppCmd]:
+        """Sends cmd and yields the response frames as they arrive, the last carries Null
+
+        Frames still arriving after the caller stops iterating are dropped,
+        the request stays registered until its last frame so they are never
+        taken for a later request with the same ID.
+        """
+        pending = await self._request(cmd, expect, multi=True)
+        try:
+            while True:
+                rsp = await self._next(pending)
+                # done is set as the last frame is queued, no decoded Null needed
+                last = pending.done and pending.queue.empty()
+                yield rsp
+                if last:
+                    return
+        finally:
+            self._forget(pending)
+
+    async def stream_into(self, cmd: WppCmd, sink: "Sink", expect: Optional[Iterable[Cmd]] = None) -> WppCmd:
+        """Streams the response to cmd into sink
+
+        Only one frame of bulk data is held at a time, the response returned
+        has the other fields merged and its TlvArray fields left empty.
+        """
+        rsp = None
+        async for frame in self.stream(cmd, expect):
+            sink(frame)
+            for array in bulk(frame):
+                array.clear()
+            if rsp is None:
+                rsp = frame
+            else:
+                rsp.merge_from(frame)
+        return rsp
+
+    async def transact_until_null(self, cmd: WppCmd, expect: Optional[Iterable[Cmd]] = None) -> WppCmd:
+        """Sends cmd and merges the response frames up to the one carrying Null"""
+        rsp = None
+        async for frame in self.stream(cmd, expect):
+            if rsp is None:
+                rsp = frame
+            else:
+                rsp.merge_from(frame)
+        return rsp
+
+    async def transact_many(self, cmds: Sequence[WppCmd]) -> List[WppCmd]:
+        """Sends all of cmds back to back, then waits for all of the responses"""
+        return list(await asyncio.gather(*(self.transact(cmd) for cmd in cmds)))
+
+    async def upload(self, cmds: Iterable[WppCmd]) -> List[WppCmd]:
+        """Sends cmds as bulk writes, keeping up to window of them in flight
+
+        For large outbound payloads such as firmware or configuration blobs
+        split over many frames.  Returns the responses in order.
+        """
+        window = asyncio.Semaphore(self.window)
+
+        async def send(cmd: WppCmd) -> WppCmd:
+            try:
+                return await self.transact(cmd, bulk=True)
+            finally:
+                window.release()
+
+        tasks = []
+        try:
+            for cmd in cmds:
+                await window.acquire()
+                tasks.append(asyncio.ensure_future(send(cmd)))
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def probe(self, kl_secret: str) -> CmdProbe:
+        """Probes the device, answering its challenge if it sends one"""
+        with self.metrics.time("probe"):
+            return await self._probe(kl_secret)
+
+    async def _probe(self, kl_secret: str) -> CmdProbe:
+        expect = (Cmd.CMD_PROBE, Cmd.CMD_PROBE_CHALLENGE)
+
+        # --send--> 0101 ~ CMD_PROBE
+        rsp = await self.transact(CmdProbe(), expect)
+
+        # <--read-- 0128 ~ CMD_PROBE_CHALLENGE
+        # <--read--  + 0122 ~ ProbeChallenge(mac = 00:24:e4:xx:xx:xx, challenge = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx ) # completely random
+        if isinstance(rsp, CmdProbeChallenge):
+            # --send--> 0128 ~ CMD_PROBE_CHALLENGE
+            # --send-->  + 0123 ~ ProbeChallengeResponse(           answer = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
+            # --send-->  + 0122 ~ ProbeChallenge(mac = 00:24:e4:xx:xx:xx, challenge = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
+            challenge = ProbeChallenge(
+                mac=rsp.challenge.mac,
+                challenge=secrets.token_bytes(16),
+            )
+            rsp = await self.transact(
+                CmdProbeChallenge(
+                    response=rsp.challenge.make_response(kl_secret),
+                    challenge=challenge,
+                ),
+                expect,
+            )
+
+            # <--read-- 0101 ~ CMD_PROBE
+            # <--read--  + 0123 ~ ProbeChallengeResponse(           answer = xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx xxxxxxxx )
+            # <--read--  + 0101 ~ ProbeReply(vid = 0, pid = 0, name = ScanWatch, mac = 00:24:e4:xx:xx:xx, secret = xxxxxxxxxxxxxxxx, hardVersion = 16777215, mfgId = 001F0080, blVersion = 6, softVersion = 2741, rescueVersion = 16777215)
+            # <--read--  + 012C ~ FactoryState(value = 0)
+            assert isinstance(rsp, CmdProbe)
+            assert rsp.response == challenge.make_response(kl_secret)
+
+        return rsp
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""A simulated Withings device, the server side of WPP
+
+Serves the probe handshake, SPI flash reads and debug dumps from local files
+over any Transport, usually the far end of a LoopbackTransport.pair(), so the
+session, flash dump and debug dump code can be run and benchmarked without a
+watch.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import logging
+import random
+import secrets
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from wpp import (
+    BatteryPercent,
+    BatteryStatus,
+    BatteryVoltage,
+    Cmd,
+    CmdBatteryPercent,
+    CmdBatteryStatus,
+    CmdDebugDump,
+    CmdDebugDumpAck,
+    CmdDebugSet,
+    CmdDisconnect,
+    CmdError,
+    CmdMtuExch,
+    CmdProbe,
+    CmdProbeChallenge,
+    CmdSpiFlash,
+    CmdTrackerUserGet,
+    DebugDumpAnchor,
+    DebugDumpMask,
+    DebugDumpType,
+    DebugDumpTypeEnum,
+    DebugMask,
+    FactoryState,
+    MtuWpp,
+    Null,
+    ProbeChallenge,
+    ProbeReply,
+    RawDataReadModeEnum,
+    TrackerUser,
+    WppCmd,
+    WppError,
+    WppErrorEnum,
+    WppFramer,
+)
+from transport import LoopbackTransport, Transport
+
+
+logger = logging.getLogger(__name__)
+
+TEST_SECRET = "0123456789abcdef0123456789abcdef"
+FAKE_MAC = "00:24:e4:00:00:01"
+
+T = TypeVar("T")
+
+# which debug dumps each DebugMask bit selects
+_DUMP_MASKS = {
+    DebugDumpTypeEnum.DBLIB: DebugMask.DBLIB_DUMP,
+    DebugDumpTypeEnum.WLOG: DebugMask.WLOG,
+    DebugDumpTypeEnum.RAW: DebugMask.RAWDATA,
+}
+
+
+class SimDevice:
+    """Answers WPP requests arriving on transport
+
+    flash is served by CMD_SPI_FLASH, reads past its end or longer than
+    max_read fail with ARG_INVAL.  dumps are served in order by
+    CMD_DEBUG_DUMP, filtered by the mask last set with CMD_DEBUG_SET.  With
+    WPP_RAW_DATA_READ_NOT_SENT only what was not acknowledged with
+    CMD_DEBUG_DUMP_ACK yet is sent, dumps may grow between syncs.
+
+    Every notification is delayed by latency seconds and carries at most mtu
+    bytes, a response frame is lost with probability drop_rate.
+    """
+
+    def __init__(
+        self,
+        transport: Transport,
+        kl_secret: str = TEST_SECRET,
+        flash: bytes = b"",
+        dumps: Sequence[Tuple[DebugDumpTypeEnum, bytes]] = (),
+        mtu: Optional[int] = None,
+        latency: float = 0.0,
+        drop_rate: float = 0.0,
+        max_read: int = 0x10000,
+        seed: int = 0,
+    ):
+        self.transport = transport
+        transport.on_receive = self._on_data
+        self.kl_secret = kl_secret
+        self.flash = flash
+        self.dumps = list(dumps)
+        self.mtu = transport.mtu if mtu is None else min(mtu, transport.mtu)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.max_read = max_read
+        self.rng = random.Random(seed)
+        self.framer = WppFramer()
+        self.requests: asyncio.Queue[WppCmd] = asyncio.Queue()
+        self.mask = DebugMask.DBLIB_DUMP
+        # bytes of each dump acknowledged, and sent since the last ack
+        self.acked = [0] * len(self.dumps)
+        self.sent: Dict[int, int] = {}
+        self.challenge: Optional[ProbeChallenge] = None
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_files(
+        cls,
+        transport: Transport,
+        flash: Optional[Path] = None,
+        dblib: Sequence[Path] = (),
+        wlog: Sequence[Path] = (),
+        raw: Sequence[Path] = (),
+        **kwargs,
+    ) -> "SimDevice":
+        dumps = [(DebugDumpTypeEnum.DBLIB, p.read_bytes()) for p in dblib]
+        dumps += [(DebugDumpTypeEnum.WLOG, p.read_bytes()) for p in wlog]
+        dumps += [(DebugDumpTypeEnum.RAW, p.read_bytes()) for p in raw]
+        return cls(transport, flash=flash.read_bytes() if flash else b"", dumps=dumps, **kwargs)
+
+    async def __aenter__(self) -> "SimDevice":
+        await self.transport.start()
+        self.task = asyncio.ensure_future(self.serve())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    def _on_data(self, data: bytes):
+        for frame in self.framer.feed(data):
+            self.requests.put_nowait(WppCmd.deserialize(frame))
+
+    async def serve(self):
+        """Answers requests one at a time, in the order they arrived"""
+        while True:
+            cmd = await self.requests.get()
+            handler = getattr(self, f"on_{type(cmd).__name__}", None)
+            if handler is None:
+                await self.error(cmd, WppErrorEnum.CMDUNKN)
+                continue
+            await handler(cmd)
+
+    async def notify(self, cmd: WppCmd):
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.frames_dropped += 1
+            return
+        data = cmd.serialize()
+        for start in range(0, len(data), self.mtu):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            await self.transport.send(data[start : start + self.mtu], response=False)
+        self.frames_sent += 1
+
+    async def error(self, cmd: WppCmd, err: WppErrorEnum):
+        cmd_id = cmd.ID()
+        cmd_id = cmd_id.value if isinstance(cmd_id, Cmd) else cmd_id
+        await self.notify(CmdError(error=WppError(cmd=cmd_id, err=err)))
+
+    async def on_CmdProbe(self, cmd: CmdProbe):
+        self.challenge = ProbeChallenge(mac=FAKE_MAC, challenge=secrets.token_bytes(16))
+        await self.notify(CmdProbeChallenge(challenge=self.challenge))
+
+    async def on_CmdProbeChallenge(self, cmd: CmdProbeChallenge):
+        if self.challenge is None or cmd.response != self.challenge.make_response(self.kl_secret):
+            await self.error(cmd, WppErrorEnum.AUTH_ERR)
+            return
+        await self.notify(
+            CmdProbe(
+                response=cmd.challenge.make_response(self.kl_secret),
+                reply=ProbeReply(
+                    vid=0,
+                    pid=0,
+                    name="SimWatch",
+                    mac=FAKE_MAC,
+                    secret="0000000000000000",
+                    hard_version=0xFFFFFF,
+                    mfg_id="001F0080",
+                    bl_version=6,
+                    soft_version=2741,
+                    rescue_version=0xFFFFFF,
+                ),
+                factory_state=FactoryState(value=0),
+            )
+        )
+
+    async def on_CmdMtuExch(self, cmd: CmdMtuExch):
+        mtu = self.mtu if cmd.wpp is None else min(self.mtu, cmd.wpp.mtu)
+        await self.notify(CmdMtuExch(wpp=MtuWpp(mtu=mtu)))
+
+    async def on_CmdBatteryStatus(self, cmd: CmdBatteryStatus):
+        await self.notify(CmdBatteryStatus(status=BatteryStatus(percent=80, state=1, mv=3950, reserved=0)))
+
+    async def on_CmdBatteryPercent(self, cmd: CmdBatteryPercent):
+        await self.notify(CmdBatteryPercent(percent=BatteryPercent(percent=80), voltage=BatteryVoltage(mv=3950)))
+
+    async def on_CmdTrackerUserGet(self, cmd: CmdTrackerUserGet):
+        user = TrackerUser(uid=1, weight_g=70000, height_cm=175, gender=0, birth=datetime(1990, 1, 1), first_name="Sim")
+        await self.notify(CmdTrackerUserGet(user=user))
+
+    async def on_CmdSpiFlash(self, cmd: CmdSpiFlash):
+        if cmd.cmd is None:
+            await self.error(cmd, WppErrorEnum.ARG_NOT_SET)
+            return
+        addr, length = cmd.cmd.addr, cmd.cmd.len
+        if length > self.max_read or addr + length > len(self.flash):
+            await self.error(cmd, WppErrorEnum.ARG_INVAL)
+            return
+
+        # whole 16 byte chunks, as many as fit in a notification
+        per_frame = max(1, (self.mtu - 5) // 21)
+        end = addr + length
+        while True:
+            frame = CmdSpiFlash()
+            for _ in range(per_frame):
+                if addr >= end:
+                    break
+                frame.chunks.append_payload(self.flash[addr : addr + 16].ljust(16, b"\xff"))
+                addr += 16
+            if addr >= end:
+                frame.null = Null()
+                await self.notify(frame)
+                return
+            await self.notify(frame)
+
+    async def on_CmdDebugSet(self, cmd: CmdDebugSet):
+        if cmd.mask is not None:
+            self.mask = cmd.mask.mask
+        await self.notify(CmdDebugSet(null=Null()))
+
+    def _selected(self, not_sent: bool) -> List[Tuple[int, DebugDumpTypeEnum, bytes]]:
+        self.acked += [0] * (len(self.dumps) - len(self.acked))
+        selected = []
+        for i, (ty, blob) in enumerate(self.dumps):
+            start = self.acked[i] if not_sent else 0
+            if self.mask & _DUMP_MASKS[ty] and start < len(blob):
+                selected.append((i, ty, blob[start:]))
+        return selected
+
+    async def on_CmdDebugDump(self, cmd: CmdDebugDump):
+        # anchor n asks for the nth dump, the response carries the next anchor if any
+        not_sent = cmd.read_mode is not None and cmd.read_mode.mode == RawDataReadModeEnum.WPP_RAW_DATA_READ_NOT_SENT
+        dumps = self._selected(not_sent)
+        index = 0 if cmd.anchor is None else cmd.anchor.value
+        if index >= len(dumps):
+            await self.notify(CmdDebugDump(type=DebugDumpType(type=DebugDumpTypeEnum.NONE, size=0), null=Null()))
+            return
+
+        i, ty, blob = dumps[index]
+        self.sent[i] = len(self.dumps[i][1])
+        await self.notify(CmdDebugDump(type=DebugDumpType(type=ty, size=len(blob))))
+        per_frame = max(1, (self.mtu - 5) // (5 + 64))
+        pos = 0
+        while pos < len(blob):
+            frame = CmdDebugDump()
+            for _ in range(per_frame):
+                if pos >= len(blob):
+                    break
+                frame.data.append_payload(blob[pos : pos + 64])
+                pos += 64
+            await self.notify(frame)
+
+        last = CmdDebugDump(null=Null())
+        if index + 1 < len(dumps):
+            last.anchor = DebugDumpAnchor(value=index + 1)
+        await self.notify(last)
+
+    async def on_CmdDebugDumpAck(self, cmd: CmdDebugDumpAck):
+        for i, size in self.sent.items():
+            self.acked[i] = size
+        self.sent.clear()
+        await self.notify(CmdDebugDumpAck(null=Null()))
+
+    async def on_CmdDisconnect(self, cmd: CmdDisconnect):
+        await self.notify(CmdDisconnect(null=Null()))
+
+
+async def bench(args) -> None:
+    from flash_dump import FlashDump, ReadPlanner
+    from wpp_capture import CaptureTransport, CaptureWriter
+    from wpp_metrics import SessionMetrics
+    from wpp_session import WppSession
+
+    rng = random.Random(args.seed)
+    flash = args.flash.read_bytes() if args.flash else rng.randbytes(args.size)
+    dumps = [(DebugDumpTypeEnum.DBLIB, p.read_bytes()) for p in args.dblib]
+    dumps += [(DebugDumpTypeEnum.WLOG, p.read_bytes()) for p in args.wlog]
+    if not dumps:
+        dumps = [(DebugDumpTypeEnum.DBLIB, rng.randbytes(0x2000)), (DebugDumpTypeEnum.WLOG, rng.randbytes(0x4000))]
+
+    capture = CaptureWriter(args.capture) if args.capture else None
+    metrics = SessionMetrics()
+    devices: List[SimDevice] = []
+    link = contextlib.AsyncExitStack()
+    session: Optional[WppSession] = None
+
+    async def connect() -> WppSession:
+        """The current session, or a probed one to a fresh device"""
+        nonlocal session
+        if session is not None:
+            return session
+        client_end, device_end = LoopbackTransport.pair(args.mtu)
+        device = SimDevice(
+            device_end,
+            flash=flash,
+            dumps=dumps,
+            latency=args.latency,
+            drop_rate=args.drop_rate,
+            # not the frames the last one dropped
+            seed=args.seed + len(devices),
+        )
+        devices.append(device)
+        transport = client_end if capture is None else CaptureTransport(client_end, capture)
+        await link.enter_async_context(device)
+        new = await link.enter_async_context(WppSession(transport, metrics=metrics, timeout=args.timeout))
+        try:
+            await new.probe(TEST_SECRET)
+            await new.negotiate_mtu()
+        except BaseException:
+            await link.aclose()
+            raise
+        session = new
+        return session
+
+    async def retry(what: str, run: Callable[[WppSession], Awaitable[T]]) -> T:
+        # on the same link, the session drops what is left of the requests
+        # given up on
+        for attempt in itertools.count(1):
+            try:
+                return await run(await connect())
+            except (asyncio.TimeoutError, IOError) as e:
+                logger.info("%s attempt %d failed: %r", what, attempt, e)
+
+    async def mtu(session: WppSession) -> int:
+        # connect() probed it and negotiated the MTU
+        return session.mtu
+
+    try:
+        t0 = time.perf_counter()
+        negotiated = await retry("probe", mtu)
+        print(f"probe + mtu:  {(time.perf_counter() - t0) * 1000:8.1f} ms  (mtu {negotiated})")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = FlashDump(Path(tmp) / "flash.bin", 0, len(flash), planner=ReadPlanner() if args.plan else None, progress=lambda p: None)
+            t0 = time.perf_counter()
+            attempts = 0
+            while not dump.done:
+                attempts += 1
+                try:
+                    await dump.run(await connect())
+                except (asyncio.TimeoutError, IOError) as e:
+                    # a dropped frame leaves a request unanswered, start over
+                    logger.info("flash dump attempt %d failed: %r", attempts, e)
+                    dump = FlashDump(dump.path, 0, len(flash), planner=dump.planner, progress=lambda p: None)
+            dt = time.perf_counter() - t0
+            ok = (Path(tmp) / "flash.bin").read_bytes() == flash
+            print(f"flash dump:   {dt * 1000:8.1f} ms  {len(flash) / dt / 1024:8.1f} KiB/s  {attempts} attempt(s)  {'ok' if ok else 'MISMATCH'}")
+
+        async def read_dump(session: WppSession) -> CmdDebugDump:
+            # the mask is per device, set it again on every new one
+            await session.transact(CmdDebugSet(mask=DebugDumpMask(mask=DebugMask.DBLIB_DUMP | DebugMask.WLOG | DebugMask.RAWDATA)))
+            rsp = await session.transact_until_null(CmdDebugDump(anchor=anchor))
+            # a frame was dropped, ask for the same dump again
+            if rsp.type is None:
+                raise IOError("dump was never announced")
+            size = len(rsp.data.getbuffer())
+            if size != rsp.type.size:
+                raise IOError(f"dump is {size} bytes, {rsp.type.size} announced")
+            return rsp
+
+        t0 = time.perf_counter()
+        total = 0
+        anchor: Optional[DebugDumpAnchor] = DebugDumpAnchor(value=0)
+        while anchor is not None:
+            rsp = await retry("debug dump", read_dump)
+            total += len(rsp.data.getbuffer())
+            anchor = rsp.anchor
+        await retry("debug dump ack", lambda session: session.transact(CmdDebugDumpAck()))
+        dt = time.perf_counter() - t0
+        print(f"debug dump:   {dt * 1000:8.1f} ms  {total / dt / 1024:8.1f} KiB/s  {total} bytes")
+
+        frames_sent = sum(device.frames_sent for device in devices)
+        frames_dropped = sum(device.frames_dropped for device in devices)
+        print(f"frames sent {frames_sent}, dropped {frames_dropped}, {len(devices)} connection(s)")
+        if args.metrics:
+            metrics.write_prometheus(args.metrics)
+    finally:
+        await link.aclose()
+        if capture is not None:
+            capture.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flash", type=Path, help="flash image to serve, random by default")
+    parser.add_argument("--size", type=lambda s: int(s, 0), default=0x40000, help="size of the random flash image")
+    parser.add_argument("--dblib", type=Path, action="append", default=[], help="dblib dump to serve")
+    parser.add_argument("--wlog", type=Path, action="append", default=[], help="wlog dump to serve")
+    parser.add_argument("--mtu", type=int, default=244, help="bytes per notification")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per notification")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability a response frame is lost")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds without a response frame before a request is given up on")
+    parser.add_argument("--plan", action="store_true", help="size flash reads with a ReadPlanner")
+    parser.add_argument("--capture", type=Path, help="record the session, see wpp_capture.py")
+    parser.add_argument("--metrics", type=Path, help="write session metrics in Prometheus text format")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Per-frame logging for WppSession
+
+Frames are logged to the "wpp.trace" logger: a one line summary at DEBUG and
+the full pydantic repr at TRACE.  Nothing is formatted unless the level is
+enabled, which matters during dumps of hundreds of thousands of frames.
+Every record carries direction, cmd and size as extra attributes for
+structured handlers.
+"""
+
+import logging
+from typing import NamedTuple, Optional, Union
+
+from wpp import Cmd, TlvArray, WppCmd
+
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+trace_logger = logging.getLogger("wpp.trace")
+
+
+def cmd_name(cmd: Union[Cmd, int]) -> str:
+    # a RawCmd of a command this version doesn't know has a plain int ID
+    return cmd.name if isinstance(cmd, Cmd) else str(cmd)
+
+
+def summary(cmd: WppCmd) -> str:
+    """CMD_SPI_FLASH chunks[11] null, without building any reprs"""
+    parts = [cmd_name(cmd.ID())]
+    for name in type(cmd).model_fields:
+        value = getattr(cmd, name)
+        if isinstance(value, (TlvArray, list)):
+            if len(value):
+                parts.append(f"{name}[{len(value)}]")
+        elif value is not None:
+            parts.append(name)
+    return " ".join(parts)
+
+
+class FrameTrace:
+    """Logs frames as they are sent and received
+
+    With hex_every set to N, 1 in N frames is also logged as hex at DEBUG.
+    """
+
+    def __init__(self, logger: logging.Logger = trace_logger, hex_every: int = 0):
+        self.logger = logger
+        self.hex_every = hex_every
+        self.count = 0
+
+    def frame(self, direction: str, data: bytes, cmd: Optional[WppCmd] = None, note: str = ""):
+        logger = self.logger
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
+        self.count += 1
+        name = cmd_name(cmd.ID()) if cmd is not None else "?"
+        extra = {"direction": direction, "cmd": name, "size": len(data)}
+        if cmd is None:
+            logger.debug("%s %3d bytes: %s", direction, len(data), note, extra=extra)
+        elif logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "%s %3d bytes: %r", direction, len(data), cmd, extra=extra)
+        else:
+            logger.debug("%s %3d bytes: %s", direction, len(data), summary(cmd), extra=extra)
+
+        if self.hex_every and self.count % self.hex_every == 0:
+            logger.debug("%s %3d bytes: %s", direction, len(data), bytes(data).hex(), extra=extra)
+
+    def tx(self, data: bytes, cmd: WppCmd):
+        self.frame("TX", data, cmd)
+
+    def rx(self, data: bytes, cmd: Optional[WppCmd] = None, note: str = ""):
+        self.frame("RX", data, cmd, note)
+
+
+class Profile(NamedTuple):
+    level: int
+    trace_level: int
+    asyncio_debug: bool
+    hex_every: int
+
+
+PROFILES = {
+    # every frame in full, asyncio's slow callback and never-awaited checks
+    "debug": Profile(logging.DEBUG, TRACE, True, 1),
+    # frame summaries with some hex to check them against
+    "trace": Profile(logging.INFO, logging.DEBUG, False, 100),
+    # no per-frame work at all
+    "production": Profile(logging.INFO, logging.WARNING, False, 0),
+}
+
+
+def configure(profile: str = "production") -> Profile:
+    """Sets up logging for profile, pass asyncio_debug to asyncio.run()"""
+    p = PROFILES[profile]
+    logging.basicConfig(
+        level=p.level,
+        format="%(asctime)-15s %(name)-8s %(levelname)s: %(message)s",
+    )
+    trace_logger.setLevel(p.trace_level)
+    return p